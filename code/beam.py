@@ -29,6 +29,17 @@ class BeamItem(object):
           self.words[-3], self.words[-2], self.words[-1])] += 1
     self.log_probs += log_prob
 
+  def Extend(self, log_prob, new_word):
+    """Returns a copy of this item with one more word.
+
+    The states are shared with the parent, they are replaced, not modified.
+    """
+    child = BeamItem(list(self.words), self.prev_c, self.prev_h)
+    child.log_probs = self.log_probs
+    child.counts = collections.Counter(self.counts)
+    child.Update(log_prob, new_word)
+    return child
+
   def IsEligible(self, word, min_length=20, allow_repeated_trigrams=False):
     """Eligibility function allows us to constrain the beam search.
 
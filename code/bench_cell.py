@@ -0,0 +1,68 @@
+# Microbenchmark of FactorCell against FusedFactorCell inside dynamic_rnn
+import argparse
+import numpy as np
+import tensorflow as tf
+import time
+
+from factorcell import FactorCell, FusedFactorCell
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--cell_size', type=int, default=200)
+parser.add_argument('--embedding_dims', type=int, default=150)
+parser.add_argument('--context_embed_size', type=int, default=30)
+parser.add_argument('--rank', type=int, default=10)
+parser.add_argument('--batch_size', type=int, default=64)
+parser.add_argument('--num_steps', type=int, default=30)
+parser.add_argument('--layer_norm', action='store_true')
+parser.add_argument('--train', action='store_true',
+                    help='time the gradients as well as the forward pass')
+parser.add_argument('--iters', type=int, default=20)
+parser.add_argument('--threads', type=int, default=2)
+args = parser.parse_args()
+
+context_embed = tf.placeholder(tf.float32, [None, args.context_embed_size])
+inputs = tf.placeholder(tf.float32, [None, None, args.embedding_dims])
+
+outputs = {}
+grads = {}
+for name, cell_class in [('FactorCell', FactorCell),
+                         ('FusedFactorCell', FusedFactorCell)]:
+  # both cells share the same variables
+  with tf.variable_scope('cell', reuse=name != 'FactorCell'):
+    cell = cell_class(args.cell_size, args.embedding_dims, context_embed,
+                      mikilovian_adaptation=True, lowrank_adaptation=True,
+                      rank=args.rank, layer_norm=args.layer_norm,
+                      dropout_keep_prob=1.0)
+  with tf.variable_scope(name):
+    out, _ = tf.nn.dynamic_rnn(cell, inputs, dtype=tf.float32)
+  outputs[name] = out
+  grads[name] = tf.gradients(tf.reduce_sum(out), tf.trainable_variables())
+
+config = tf.ConfigProto(inter_op_parallelism_threads=args.threads,
+                        intra_op_parallelism_threads=args.threads)
+session = tf.Session(config=config)
+for v in tf.global_variables():  # small weights keep the cell out of saturation
+  v.load(0.05 * np.random.randn(*v.get_shape().as_list()), session)
+feed_dict = {
+  context_embed: np.random.randn(args.batch_size, args.context_embed_size),
+  inputs: np.random.randn(args.batch_size, args.num_steps, args.embedding_dims)
+}
+
+results = {}
+for name in outputs:
+  fetches = [outputs[name]]
+  if args.train:
+    fetches.append(grads[name])
+  results[name] = session.run(fetches, feed_dict)  # warm up
+  start_time = time.time()
+  for _ in xrange(args.iters):
+    session.run(fetches, feed_dict)
+  step_time = (time.time() - start_time) / args.iters
+  print '{0}\t{1:.2f} ms'.format(name, 1000 * step_time)
+
+diff = np.abs(results['FactorCell'][0] - results['FusedFactorCell'][0]).max()
+print 'max output difference {0:.2g}'.format(diff)
+if args.train:
+  diff = max(np.abs(a - b).max() for a, b in
+             zip(results['FactorCell'][1], results['FusedFactorCell'][1]))
+  print 'max gradient difference {0:.2g}'.format(diff)
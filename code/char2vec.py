@@ -63,8 +63,13 @@ class Char2Vec(object):
     the_filter = tf.get_variable(name, filter_sz)
     return the_filter, filter_b
 
-  def __init__(self, params, word_vocab, char_vocab, enable_char2vec=True):
+  def __init__(self, params, word_vocab, char_vocab, enable_char2vec=True,
+               cache_embeddings=False):
     self.enable_char2vec = enable_char2vec
+    # for inference the char CNN is run over the vocabulary once and the
+    # result is kept until the weights change
+    self.cache_embeddings = cache_embeddings and enable_char2vec
+    self._all_embeddings = None
 
     self.word_embeddings = tf.get_variable(
       'word_embeddings', [len(word_vocab), params.embedding_dims])
@@ -72,6 +77,7 @@ class Char2Vec(object):
     self.all_ids = tf.range(0, len(word_vocab))
 
     if enable_char2vec: 
+      self.widths = range(3, 6)  # of the second layer filters
       self.MakeCharVocabMat(word_vocab, char_vocab)
 
       self.char_embedding_size = int(np.log2(len(char_vocab)))
@@ -84,7 +90,6 @@ class Char2Vec(object):
                                                      self.layer1_out_size, 'filter1')
       self.filter2 = []
       self.bias2 = []
-      self.widths = range(3, 6)
       for width in self.widths:
         f, f_bias = Char2Vec.MakeFilter(width, self.layer1_out_size, self.layer2_out_size,
                                         'filt2_w{0}'.format(width))
@@ -92,25 +97,87 @@ class Char2Vec(object):
         self.bias2.append(f_bias)
 
       self.embedding_dims = params.embedding_dims + len(self.widths) * self.layer2_out_size
+
+      if self.cache_embeddings:
+        cnn_vars = [self.char_embeddings, self.filter1, self.bias1] + self.filter2 + self.bias2
+        self._cnn_checksum = tf.stack(
+          [tf.reduce_sum(v) for v in cnn_vars] +
+          [tf.reduce_sum(tf.square(v)) for v in cnn_vars])
+        # local variables are not saved with the model
+        self._cached_charvecs = tf.get_variable(
+          'cached_charvecs', [len(word_vocab), len(self.widths) * self.layer2_out_size],
+          trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES])
+        self._cached_checksum = tf.get_variable(
+          'cached_checksum', [2 * len(cnn_vars)], trainable=False,
+          collections=[tf.GraphKeys.LOCAL_VARIABLES])
     else:
       self.embedding_dims = params.embedding_dims
 
   def GetAllEmbeddings(self):
-    if self.enable_char2vec:
-      return self.GetEmbeddings(self.all_ids)
-    else:
+    if not self.enable_char2vec:
       return self.word_embeddings
+    if not self.cache_embeddings:
+      return self.GetEmbeddings(self.all_ids)
+
+    if self._all_embeddings is None:  # share one cache lookup in the graph
+      self._all_embeddings = tf.concat(
+        axis=1, values=[self.GetCachedCharVecs(), self.word_embeddings])
+    return self._all_embeddings
+
+  def GetCachedCharVecs(self):
+    """Char CNN output for the whole vocabulary, recomputed if the weights changed."""
+
+    def Refresh():
+      charvecs = self.GetCharVecs(self.all_ids)
+      with tf.control_dependencies(
+          [tf.assign(self._cached_checksum, self._cnn_checksum)]):
+        return tf.identity(tf.assign(self._cached_charvecs, charvecs))
+
+    def Check():
+      is_current = tf.reduce_all(
+        tf.equal(self._cached_checksum.read_value(), self._cnn_checksum))
+      return tf.cond(is_current, self._cached_charvecs.read_value, Refresh)
+
+    return tf.cond(tf.is_variable_initialized(self._cached_checksum),
+                   Check, Refresh)
 
   def GetEmbeddings(self, word_ids):
     if not self.enable_char2vec:
       return tf.nn.embedding_lookup(self.word_embeddings, word_ids)
+    if self.cache_embeddings:
+      return tf.nn.embedding_lookup(self.GetAllEmbeddings(), word_ids)
 
     if len(word_ids.get_shape()) > 1:
       unique_ids, unique_idxs = tf.unique(tf.reshape(word_ids, [-1]))
-      unique_idxs = tf.reshape(unique_idxs, word_ids.get_shape())
+      unique_idxs = tf.reshape(unique_idxs, tf.shape(word_ids))
     else:
       unique_ids, unique_idxs = tf.unique(word_ids)
-    selected_words = tf.nn.embedding_lookup(self.words_as_chars, unique_ids)
+    charvecs = tf.nn.embedding_lookup(self.GetCharVecs(unique_ids), unique_idxs)
+    wordvecs = tf.nn.embedding_lookup(self.word_embeddings, word_ids)
+    finalvecs = tf.concat(axis=len(charvecs.get_shape()) - 1, values=[charvecs, wordvecs])
+
+    return finalvecs
+
+  def GetCharVecs(self, unique_ids):
+    """Runs the char CNN over the given words, grouped by length."""
+    # each word goes in the first bucket that fits it
+    lens = tf.expand_dims(tf.gather(self.word_lens, unique_ids), 1)
+    buckets = tf.reduce_sum(tf.to_int32(tf.greater(lens, self.bucket_lens[:-1])), 1)
+    num_buckets = len(self.bucket_lens)
+    positions = tf.dynamic_partition(tf.range(tf.shape(unique_ids)[0]), buckets,
+                                     num_buckets)
+    bucket_ids = tf.dynamic_partition(unique_ids, buckets, num_buckets)
+
+    pooled = [self.CharCNN(ids, width)
+              for ids, width in zip(bucket_ids, self.bucket_widths)]
+    charvecs = tf.dynamic_stitch(positions, pooled)
+    charvecs.set_shape((None, len(self.widths) * self.layer2_out_size))
+    return charvecs
+
+  def CharCNN(self, word_ids, pad_width):
+    """Runs the char CNN over words padded to pad_width characters."""
+    selected_words = tf.nn.embedding_lookup(self.words_as_chars, word_ids)
+    selected_words = selected_words[:, :pad_width]
 
     # z is a tensor of dimensions batch_sz x word_len x embed_dims.
     z = tf.nn.embedding_lookup(self.char_embeddings, selected_words)
@@ -118,8 +185,8 @@ class Char2Vec(object):
 
     conv = tf.nn.conv2d(z_expanded, self.filter1, strides=[1, 1, 1, 1],
                         padding='VALID' )
-    h = tf.nn.relu(tf.nn.bias_add(tf.squeeze(conv), self.bias1))
-    h.set_shape((None, self.max_len - 2, self.layer1_out_size))
+    h = tf.nn.relu(tf.nn.bias_add(tf.squeeze(conv, [2]), self.bias1))
+    h.set_shape((None, pad_width - 2, self.layer1_out_size))
     h_expanded = tf.expand_dims(h, -1)
 
     pools = []
@@ -127,16 +194,11 @@ class Char2Vec(object):
       conv2 = tf.nn.conv2d(h_expanded, f, strides=[1, 1, 1, 1],
                            padding='VALID')
       h2 = tf.nn.relu(tf.nn.bias_add(conv2, f_bias))
-      pooled = tf.nn.max_pool(h2, ksize=[1, self.max_len - 1 - width, 1, 1],
+      pooled = tf.nn.max_pool(h2, ksize=[1, pad_width - 1 - width, 1, 1],
                               strides=[1, 1, 1, 1], padding='VALID')
       pools.append(pooled)
 
-    pooled = tf.squeeze(tf.concat(axis=3, values=pools), [1, 2])
-    charvecs = tf.nn.embedding_lookup(pooled, unique_idxs)
-    wordvecs = tf.nn.embedding_lookup(self.word_embeddings, word_ids)
-    finalvecs = tf.concat(axis=len(charvecs.get_shape()) - 1, values=[charvecs, wordvecs])
-
-    return finalvecs
+    return tf.squeeze(tf.concat(axis=3, values=pools), [1, 2])
 
   def MakeCharVocabMat(self, word_vocab, char_vocab):
     graphemes = [['{'] + Vocab.Graphemes(x) + ['}'] for x in word_vocab.GetWords()]
@@ -150,8 +212,32 @@ class Char2Vec(object):
         ids += [char_vocab['}']] * (self.max_len - len(ids))
       grapheme_ids.append(ids)
       
+    self.MakeLengthBuckets(lengths)
     self.word_lens = tf.Variable(trainable=False, initial_value=lengths, name='word_lens')
     self.words_as_chars = tf.Variable(trainable=False, initial_value=grapheme_ids, 
                                       name='words_as_chars')
 
-
+  def MakeLengthBuckets(self, lengths):
+    """Pick the length buckets and how far the words in each are padded.
+
+    The padding is all '}' so the windows that lie entirely in the padding
+    have the same value. The pooled result is unchanged as long as each
+    word keeps one such window for the widest filter, which takes
+    max(self.widths) + 1 characters of padding after the closing '}'.
+    """
+    bucket_lens = []
+    upper = 8
+    while upper < self.max_len:
+      bucket_lens.append(upper)
+      upper = upper * 3 / 2
+    bucket_lens.append(self.max_len)
+
+    lengths = np.array(lengths)
+    lower = 0
+    self.bucket_lens = []
+    for upper in bucket_lens:  # skip the empty buckets
+      if np.any((lengths > lower) & (lengths <= upper)):
+        self.bucket_lens.append(upper)
+      lower = upper
+    self.bucket_widths = [min(upper + max(self.widths) + 1, self.max_len)
+                          for upper in self.bucket_lens]
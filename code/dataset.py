@@ -1,17 +1,37 @@
 # load, preprocess, and managage datasets
 import argparse
-import bz2
+import collections
+import cPickle as pickle
+import functools
 import gzip
+import hashlib
+import multiprocessing
 import numpy as np
+import os
 import pandas
+import Queue
 import re
+import shutil
+import sys
+import threading
+import time
 
-from vocab import Vocab
+from decompress import BlockReader, DecompressBlocks
+from vocab import CountTokens, Vocab
+import helper
 
 
-def GetFileHandle(filename):
-  if filename.endswith('.bz2'):
-    return bz2.BZ2File(filename, 'r')
+# suffix of the files written by WriteChunkFile
+CHUNK_FILE_SUFFIX = '.chunks'
+
+# bumped whenever the layout written by SaveCache changes
+CACHE_VERSION = '2'
+
+
+def GetFileHandle(filename, num_workers=1):
+  # BZ2File stops after the first stream of a multi-stream file
+  if filename.endswith('.bz2') or (filename.endswith('.gz') and num_workers > 1):
+    return BlockReader(DecompressBlocks(filename, num_workers))
   if filename.endswith('.gz'):
     return gzip.open(filename, 'r')
   return open(filename, 'r')
@@ -45,38 +65,250 @@ def NgramSplitter(text):
   return [c if c != ' ' else 'SPACE' for c in chars]
 
 
-def ReadData(filename, columns, limit):
-  with GetFileHandle(filename) as f:
-    data = pandas.read_csv(f, sep='\t', nrows=limit, header=None)
-    data = data.fillna('')
+def SplitLines(split_func, lines):
+  """Tokenize a list of texts and count the tokens."""
+  split_lines = [split_func(line) for line in lines]
+  return split_lines, CountTokens(split_lines)
+
+
+def CountSplitTokens(split_func, lines):
+  return CountTokens(split_func(line) for line in lines)
+
+
+def SplitChunks(split_func, columns, types, chunks):
+  """Set the column types and tokenize the text of a list of dataframes."""
+  for chunk in chunks:
+    SetTypes(chunk, columns, types)
+    chunk['text'] = [split_func(line) for line in chunk['text'].values]
+  return chunks
+
+
+def ReadData(filename, columns, limit, num_workers=1):
+  if filename.endswith(CHUNK_FILE_SUFFIX):
+    data = pandas.concat(ReadChunkFile(filename, limit))
+  else:
+    with GetFileHandle(filename, num_workers) as f:
+      data = pandas.read_csv(f, sep='\t', nrows=limit, header=None)
+      data = data.fillna('')
   if columns:
     data.columns = columns
 
   return data
 
 
-def ReadMultiple(filenames, columns, limit):
+def ReadChunks(filename, columns, limit, chunksize, num_workers=1):
+  """Like ReadData but yields the file as a sequence of smaller dataframes."""
+  for chunk in _ReadFrames(filename, limit, chunksize, num_workers):
+    if columns:
+      chunk.columns = columns
+    yield chunk
+
+
+def _ReadFrames(filename, limit, chunksize, num_workers):
+  if filename.endswith(CHUNK_FILE_SUFFIX):
+    for frame in ReadChunkFile(filename, limit):
+      for start in xrange(0, len(frame), chunksize):
+        yield frame.iloc[start:start + chunksize]
+    return
+
+  with GetFileHandle(filename, num_workers) as f:
+    reader = pandas.read_csv(f, sep='\t', nrows=limit, header=None,
+                             chunksize=chunksize)
+    for chunk in reader:
+      yield chunk.fillna('')
+
+
+def WriteChunkFile(filename, out, chunksize=100000, num_workers=1):
+  """Convert a tsv file into a sequence of pickled dataframes.
+
+  Reading the result needs no decompression or csv parsing, so it is limited
+  by the disk rather than the cpu.
+  """
+  with open(out, 'wb') as f:
+    for chunk in ReadChunks(filename, None, None, chunksize, num_workers):
+      pickle.dump(chunk, f, pickle.HIGHEST_PROTOCOL)
+
+
+def ReadChunkFile(filename, limit=None):
+  """Yields the dataframes in a file written by WriteChunkFile."""
+  with open(filename, 'rb') as f:
+    while limit is None or limit > 0:
+      try:
+        frame = pickle.load(f)
+      except EOFError:
+        return
+      if limit is not None:
+        frame = frame.iloc[:limit]
+        limit -= len(frame)
+      yield frame
+
+
+def SetTypes(data, columns, types):
+  """Cast the context columns to their categorical or numerical types."""
+  if not types:
+    return
+  for i, t in zip(columns, types):
+    data[i] = CastColumn(data[i], t)
+
+
+def CastColumn(values, t):
+  return values.astype(str) if t == 'categorical' else values.astype(float)
+
+
+def SaveCache(path, data, context_vocabs):
+  """Save a prepared dataset as a directory of numpy arrays.
+
+  The token ids are stored as the padded int32 matrix so that loading can
+  memory-map it as is and concurrent jobs share its pages. The directory
+  is written under a temporary name and then renamed so that concurrent
+  jobs never see a partial cache.
+  """
+  tmp_path = '{0}.tmp{1}'.format(path, os.getpid())
+  os.makedirs(tmp_path)
+
+  np.save(os.path.join(tmp_path, 'text.npy'), data.text.astype(np.int32, copy=False))
+  np.save(os.path.join(tmp_path, 'seq_lens.npy'), data.seq_lens)
+
+  for c in data.keys():
+    if c in ('text', 'seq_lens'):
+      continue
+    values = data[c]
+    if values.dtype == object:
+      values = values.astype(str)
+    name = c if c.startswith('orig_') else 'ctx_{0}'.format(c)
+    np.save(os.path.join(tmp_path, name + '.npy'), values)
+
+  try:
+    os.rename(tmp_path, path)
+  except OSError:  # another job wrote the same cache first
+    shutil.rmtree(tmp_path)
+
+
+def LoadCache(path, columns):
+  """Memory-map a cache written by SaveCache as a column store."""
+  def Load(name):
+    return np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+
+  data = ColumnStore()
+  for c in columns:
+    if c == 'text':
+      data['text'] = Load('text')
+      data['seq_lens'] = Load('seq_lens')
+    else:
+      data[c] = Load('ctx_{0}'.format(c))
+      if os.path.exists(os.path.join(path, 'orig_{0}.npy'.format(c))):
+        data['orig_{0}'.format(c)] = Load('orig_{0}'.format(c))
+  return data
+
+
+class ColumnStore(object):
+  """A set of named numpy arrays that all have the same number of rows.
+
+  A prepared dataset is held as a padded int32 matrix of token ids called
+  text, an array of seq_lens and one array per context variable. Mini-batches
+  taken from it are also column stores. Columns can be accessed either as
+  attributes or with [] like the columns of a dataframe.
+  """
+
+  def __init__(self, columns=()):
+    self.__dict__['_columns'] = collections.OrderedDict(columns)
+
+  def __getattr__(self, name):
+    try:
+      return self._columns[name]
+    except KeyError:
+      raise AttributeError(name)
+
+  def __getitem__(self, name):
+    return self._columns[name]
+
+  def __setitem__(self, name, values):
+    self._columns[name] = values
+
+  def __contains__(self, name):
+    return name in self._columns
+
+  def __len__(self):
+    return len(self._columns['seq_lens'])
+
+  def keys(self):
+    return self._columns.keys()
+
+  def Slice(self, start, end):
+    """Returns rows start to end as views, nothing is copied."""
+    return ColumnStore((c, v[start:end]) for c, v in self._columns.iteritems())
+
+  def Take(self, idx):
+    """Returns a new store with copies of the rows in idx."""
+    return ColumnStore((c, np.take(v, idx, axis=0))
+                       for c, v in self._columns.iteritems())
+
+  @staticmethod
+  def Concat(stores):
+    return ColumnStore((c, np.concatenate([s[c] for s in stores]))
+                       for c in stores[0].keys())
+
+
+def ReadMultiple(filenames, columns, limit, num_workers=1):
     dfs = []
     for filename in filenames:
-      dfs.append(ReadData(filename, columns, limit))
+      dfs.append(ReadData(filename, columns, limit, num_workers))
     return pandas.concat(dfs)
 
 
 class Dataset(object):
 
-  def __init__(self, max_len=35, batch_size=100, preshuffle=True, name='unnamed'):
+  def __init__(self, max_len=35, batch_size=100, preshuffle=True, name='unnamed',
+               streaming=False, shuffle_buffer=100000, chunksize=10000,
+               cache_dir=None, bucket=False, bucket_window=100, pack=False,
+               num_workers=1, seed=None, partial_batches=False):
     """Init the dataset object.
 
     Args:
       batch_size: size of mini-batch
       preshuffle: should the order be scrambled before the first epoch
       name: optional name for the dataset
+      streaming: read the training files in chunks instead of loading them
+        into memory, batches are drawn from a bounded shuffle buffer
+      shuffle_buffer: number of sentences held in the shuffle buffer
+      chunksize: number of lines read from a file at a time when streaming
+      cache_dir: if set, prepared datasets are saved here as arrays of
+        token ids and memory-mapped by later runs on the same files & vocab
+      bucket: group sentences of similar length into the same mini-batch
+      bucket_window: number of batches worth of sentences that are sorted
+        together when bucketing
+      pack: put several sentences with the same context back-to-back in
+        each row of a mini-batch, only for training
+      num_workers: number of processes to use for tokenization and threads
+        for decompressing bz2 and gzip files
+      seed: random seed for the order of the epochs, by default the global
+        numpy random state is used
+      partial_batches: end each epoch with a smaller batch holding the rows
+        that are left over instead of skipping them
     """
+    if pack and streaming:
+      raise ValueError('packing is not supported when streaming')
     self.batch_size = batch_size
     self.preshuffle = preshuffle
     self._max_len = max_len
+    self.streaming = streaming
+    self._shuffle_buffer = max(shuffle_buffer, 2 * batch_size)
+    self._chunksize = chunksize
+    self.cache_dir = cache_dir
+    self.bucket = bucket
+    self._bucket_window = bucket_window
+    self.pack = pack
+    self.num_workers = num_workers
+    self._rng = np.random if seed is None else np.random.RandomState(seed)
+    self.partial_batches = partial_batches
+    # the tokenizing processes are forked once, from the main thread, rather
+    # than on every pass from the prefetch thread while TF is running
+    self._pool = multiprocessing.Pool(num_workers) if num_workers > 1 else None
 
   def GetColumn(self, name):
+    if self.streaming:
+      return self._StreamColumn(name)
+    self._EnsureLoaded()
     return self.data[name]
 
   def ReadData(self, filenames, columns, valdata=[], limit=10000000,
@@ -84,31 +316,135 @@ class Dataset(object):
     SplitFunc = {'word': WordSplitter, 'char': CharSplitter,
                  'speech': SpeechSplitter}[splitter]
 
-    self.data = ReadMultiple(filenames, columns, limit)
-    if types:
-      for i, t in zip(columns, types):
-        if t == 'categorical':
-          self.data[i] = self.data[i].astype(str)
-        else:
-          self.data[i] = self.data[i].astype(float)
-
-    self.data['text'] = self.data['text'].apply(SplitFunc)
+    self._split_func = SplitFunc
+    self._splitter = splitter
+    self._filenames = filenames
+    self._valfilenames = valdata
+    self._columns = columns
+    self._types = types
+    self._limit = limit
 
+    self.data = None
     self.valdata = None
+    self._order = None
+    if self.cache_dir:
+      return  # defer reading until we know if the cache can be used
+
+    if not self.streaming:
+      self.data = self._ReadFiles(filenames)
+
+    # the validation data is assumed to be small enough to always fit in memory
     if len(valdata) > 0:
-      self.valdata = ReadMultiple(valdata, columns, limit)
-      if types:
-        for i, t in zip(columns, types):
-          if t == 'categorical':
-            self.valdata[i] = self.valdata[i].astype(str)
-          else:
-            self.valdata[i] = self.valdata[i].astype(float)
-      self.valdata['text'] = self.valdata['text'].apply(SplitFunc)
+      self.valdata = self._ReadFiles(valdata)
+
+    if self.streaming:
+      print 'streaming from {0} files'.format(len(filenames))
+    else:
+      print 'loaded {0} sentences'.format(len(self.data))
+
+  def _ReadFiles(self, filenames):
+    data = ReadMultiple(filenames, self._columns, self._limit,
+                        self.num_workers).reset_index(drop=True)
+    SetTypes(data, self._columns, self._types)
+    data['text'], token_counts = self._Split(data['text'].values)
+    if filenames == self._filenames:
+      self._token_counts = token_counts
+    return data
 
-    print 'loaded {0} sentences'.format(len(self.data))
+  def _Split(self, texts):
+    """Tokenize a column of texts, in parallel if there are multiple workers.
+
+    Returns the tokenized lines and a counter of the tokens in them.
+    """
+    split_func = functools.partial(SplitLines, self._split_func)
+    lines = []
+    token_counts = collections.Counter()
+    for chunk, chunk_counts in helper.ChunkedMap(split_func, texts, self.num_workers,
+                                                 pool=self._pool):
+      lines += chunk
+      token_counts.update(chunk_counts)
+    return lines, token_counts
+
+  def GetTokenCounts(self):
+    """Count the tokens in the training data, used to build the vocabulary."""
+    if self.streaming:  # only the counts come back from the workers
+      token_counts = collections.Counter()
+      count_func = functools.partial(CountSplitTokens, self._split_func)
+      texts = (t for chunk in self._ReadRawChunks() for t in chunk['text'].values)
+      for partial_counts in helper.ChunkedMap(count_func, texts, self.num_workers,
+                                              pool=self._pool):
+        token_counts.update(partial_counts)
+      return token_counts
+    self._EnsureLoaded()
+    return self._token_counts
+
+  def _EnsureLoaded(self):
+    if self.data is None:
+      self.data = self._ReadFiles(self._filenames)
+      print 'loaded {0} sentences'.format(len(self.data))
+
+  def _ReadRawChunks(self):
+    for filename in self._filenames:
+      for chunk in ReadChunks(filename, self._columns, self._limit,
+                              self._chunksize, self.num_workers):
+        yield chunk
+
+  def _ReadChunks(self):
+    """Make one pass over the training files, yielding typed & split chunks."""
+    split_func = functools.partial(SplitChunks, self._split_func, self._columns,
+                                   self._types)
+    for chunks in helper.ChunkedMap(split_func, self._ReadRawChunks(),
+                                    self.num_workers, chunksize=1,
+                                    pool=self._pool):
+      for chunk in chunks:
+        yield chunk
+
+  def _StreamColumn(self, name):
+    """Yield the values of one column, only tokenizing the text if asked for."""
+    if name == 'text':
+      for chunk in self._ReadChunks():
+        for val in chunk[name]:
+          yield val
+      return
+
+    t = self._types[self._columns.index(name)] if self._types else None
+    for chunk in self._ReadRawChunks():
+      values = chunk[name] if t is None else CastColumn(chunk[name], t)
+      for val in values:
+        yield val
+
+  def _StreamBatches(self, word_vocab, context_vocabs):
+    """Generate minibatches forever from the training files.
+
+    Each chunk is converted to ids as soon as it is read. Batches are taken
+    from a shuffled buffer and half of the buffer is kept around to be mixed
+    with the next chunks. The buffer is emptied at the end of every epoch.
+    """
+    buffered = []
+    while True:
+      for chunk in self._ReadChunks():
+        buffered.append(self._Prepare(chunk, word_vocab, context_vocabs))
+        if sum(len(b) for b in buffered) >= self._shuffle_buffer:
+          for batch in self._DrainBuffer(buffered, self._shuffle_buffer / 2):
+            yield batch
+      for batch in self._DrainBuffer(buffered, 0):
+        yield batch
+
+  def _DrainBuffer(self, buffered, keep):
+    """Yield shuffled batches from the buffer until at most keep rows remain."""
+    data = ColumnStore.Concat(buffered)
+    order = self._rng.permutation(len(data))
+    if self.bucket:
+      order = order[self._BucketOrder(data.seq_lens[order])]
+    data = data.Take(order)
+    num_batches = max(0, len(data) - keep) / self.batch_size
+    del buffered[:]
+    buffered.append(data.Slice(num_batches * self.batch_size, len(data)))
+    for i in xrange(num_batches):
+      yield data.Slice(i * self.batch_size, (i + 1) * self.batch_size)
 
   def GetSentences(self):
-    return self.data['text']
+    return self.GetColumn('text')
 
   @staticmethod
   def GetNumberLine(line, vocab, pad_length):
@@ -120,65 +456,269 @@ class Dataset(object):
 
   def Prepare(self, word_vocab, context_vocabs):
     self.current_idx = 0
-
-    self._Prepare(self.data, word_vocab, context_vocabs)
-    if self.valdata is not None:
-      self._Prepare(self.valdata, word_vocab, context_vocabs)
+    self._context_vars = list(context_vocabs)
+    self._pad_id = word_vocab['</S>']
+
+    if self.streaming:
+      self._stream = self._StreamBatches(word_vocab, context_vocabs)
+    elif self.cache_dir:
+      self.data = self._PrepareCached(self.data, self._filenames,
+                                      word_vocab, context_vocabs)
+    else:
+      self.data = self._Prepare(self.data, word_vocab, context_vocabs)
+
+    if len(self._valfilenames) > 0:
+      if self.cache_dir:
+        self.valdata = self._PrepareCached(self.valdata, self._valfilenames,
+                                           word_vocab, context_vocabs)
+      else:
+        self.valdata = self._Prepare(self.valdata, word_vocab, context_vocabs)
       self.current_val_idx = 0
 
-    if self.preshuffle:
+    if not self.streaming:
       self._Permute()
 
   def Filter(self, subreddits, context_var):
-    self.data = self.data[self.data[context_var].isin(subreddits)]
+    self._EnsureLoaded()
+    if self._order is None:  # not prepared yet
+      self.data = self.data[self.data[context_var].isin(subreddits)]
+      self.data = self.data.reset_index(drop=True)
+    else:
+      orig_values = self.data['orig_{0}'.format(context_var)]
+      self.data = self.data.Take(np.flatnonzero(np.in1d(orig_values, subreddits)))
+      self._Permute()
+
+  def _CacheKey(self, filenames, word_vocab, context_vocabs):
+    """Fingerprint of everything that affects the prepared data."""
+    h = hashlib.md5(CACHE_VERSION)
+    for filename in filenames:
+      h.update(repr((os.path.abspath(filename), os.path.getsize(filename),
+                     os.path.getmtime(filename))))
+    h.update(repr(([str(c) for c in self._columns], self._types and
+                   [str(t) for t in self._types], str(self._splitter),
+                   self._limit, self._max_len)))
+    h.update(word_vocab.Fingerprint())
+    for context_var in sorted(context_vocabs):
+      if context_vocabs[context_var] is not None:
+        h.update(context_var + context_vocabs[context_var].Fingerprint())
+    return h.hexdigest()
+
+  def _PrepareCached(self, df, filenames, word_vocab, context_vocabs):
+    """Return the prepared version of the data, loading it from the cache if possible.
+
+    Args:
+      df: the raw dataframe for these files or None if it has not been read yet
+      filenames: the files that the data comes from
+    """
+    path = os.path.join(self.cache_dir,
+                        self._CacheKey(filenames, word_vocab, context_vocabs))
+    if os.path.exists(path):
+      data = LoadCache(path, self._columns)
+      print 'loaded {0} sentences from {1}'.format(len(data), path)
+      return data
+
+    if df is None:
+      df = self._ReadFiles(filenames)
+      print 'loaded {0} sentences'.format(len(df))
+    data = self._Prepare(df, word_vocab, context_vocabs)
+    SaveCache(path, data, context_vocabs)
+    return data
 
   def _Prepare(self, df, word_vocab, context_vocabs):
-    df['seq_lens'] = df['text'].apply(
-      lambda x: min(len(x), self._max_len))
-    df['text'] = df['text'].apply(
-      lambda x: self.GetNumberLine(x, word_vocab, self._max_len))
-    for context_var in context_vocabs:
-      if context_vocabs[context_var] == None:
-        continue  # skip numerical vars
-      vocab = context_vocabs[context_var]
-      df['orig_{0}'.format(context_var)] = df[context_var]
-      df[context_var] = df[context_var].apply(
-        lambda x: vocab.LookupIdx(x))
+    """Convert a dataframe of tokenized text into a column store of ids."""
+    data = ColumnStore()
+    for c in df.columns:
+      if c == 'text':
+        data['text'], data['seq_lens'] = word_vocab.LookupIds(df['text'].values,
+                                                              self._max_len)
+      elif context_vocabs.get(c) is not None:
+        data[c] = context_vocabs[c].LookupIdxs(df[c].values)
+        data['orig_{0}'.format(c)] = df[c].values
+      else:  # numerical context
+        data[c] = df[c].values
+    return data
 
   def GetNumBatches(self):
     """Returns num batches per epoch."""
-    return len(self.data) / self.batch_size
+    if self.partial_batches:
+      return (len(self._order) + self.batch_size - 1) / self.batch_size
+    return len(self._order) / self.batch_size
 
   def _Permute(self):
-    """Shuffle the training data."""
-    self.data = self.data.sample(frac=1).reset_index(drop=True)
+    """Choose the order of the rows for the next epoch.
+
+    The data itself is never reordered, batches are gathered through the
+    permutation in self._order.
+    """
+    order = np.arange(len(self.data))
+    if self.preshuffle:
+      order = self._rng.permutation(len(self.data))
+
+    if self.pack:
+      self.packed = self._Pack(self.data, order)
+      order = np.arange(len(self.packed))
+      if self.preshuffle:
+        order = self._rng.permutation(len(self.packed))
+    elif self.bucket:
+      order = order[self._BucketOrder(self.data.seq_lens[order])]
+    self._in_order = not (self.preshuffle or self.pack or self.bucket)
+    self._order = order
+
+  def _Pack(self, data, order):
+    """Concatenate sentences that share the same context into full rows.
+
+    Sentences are packed greedily in the given order. The seq_lens of a
+    packed row is its total length and its starts column has a one at the
+    position of the first token of each sentence.
+    """
+    # sort the rows by context and then by their position in the order
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    keys = [rank] + [data[c] for c in reversed(self._context_vars)]
+    rows = np.lexsort(keys)
+    same_context = np.ones(len(rows), dtype=bool)
+    for c in self._context_vars:
+      same_context[1:] &= data[c][rows[1:]] == data[c][rows[:-1]]
+    texts = data.text
+    lens = data.seq_lens
+
+    first_rows, packed_text, packed_lens, packed_starts = [], [], [], []
+    def Flush(sentences, starts, length):
+      text = np.empty(self._max_len, dtype=texts.dtype)
+      text.fill(self._pad_id)
+      text[:length] = np.concatenate([texts[i, :lens[i]] for i in sentences])
+      starts_row = np.zeros(self._max_len, dtype=np.float32)
+      starts_row[starts] = 1.0
+      first_rows.append(sentences[0])
+      packed_text.append(text)
+      packed_lens.append(length)
+      packed_starts.append(starts_row)
+
+    sentences, starts, length = [], [], 0
+    for i, same in zip(rows, same_context):
+      if sentences and (not same or length + lens[i] > self._max_len):
+        Flush(sentences, starts, length)
+        sentences, starts, length = [], [], 0
+      sentences.append(i)
+      starts.append(length)
+      length += lens[i]
+    if sentences:
+      Flush(sentences, starts, length)
+
+    packed = data.Take(first_rows)
+    packed['text'] = np.array(packed_text)
+    packed['seq_lens'] = np.array(packed_lens, dtype=np.int32)
+    packed['starts'] = np.array(packed_starts)
+    return packed
+
+  def _BucketOrder(self, seq_lens):
+    """Order the rows so that each batch has sentences of similar length.
+
+    Sorting is done within windows of many batches so that the composition
+    of the batches still changes from epoch to epoch. If the data is being
+    shuffled then the order of the batches is also shuffled.
+    """
+    window = self.batch_size * self._bucket_window
+    order = np.concatenate(
+      [start + np.argsort(seq_lens[start:start + window], kind='mergesort')
+       for start in xrange(0, len(seq_lens), window)] + [np.zeros(0, np.int64)])
+    num_batches = len(order) / self.batch_size
+    batches = order[:num_batches * self.batch_size].reshape(num_batches, -1)
+    if self.preshuffle:
+      self._rng.shuffle(batches)
+    return np.concatenate([batches.ravel(), order[num_batches * self.batch_size:]])
 
   def GetNextBatch(self):
-    if self.current_idx + self.batch_size > len(self.data):
+    if self.streaming:
+      return next(self._stream)
+
+    end = self.current_idx + self.batch_size
+    if self.current_idx >= len(self._order) or (
+        end > len(self._order) and not self.partial_batches):
       self.current_idx = 0
       self._Permute()    
 
-    idx = range(self.current_idx, self.current_idx + self.batch_size)
-    self.current_idx += self.batch_size
+    start = self.current_idx
+    self.current_idx = min(start + self.batch_size, len(self._order))
 
-    return self.data.iloc[idx]
+    if self._in_order:  # the batch is a view of the data
+      return self.data.Slice(start, self.current_idx)
+    rows = self.packed if self.pack else self.data
+    return rows.Take(self._order[start:self.current_idx])
 
   def GetValBatch(self):
     if self.current_val_idx + self.batch_size > len(self.valdata):
       self.current_val_idx = 0
 
-    idx = range(self.current_val_idx, self.current_val_idx + self.batch_size)
+    start = self.current_val_idx
     self.current_val_idx += self.batch_size
-    return self.valdata.iloc[idx]
+    return self.valdata.Slice(start, self.current_val_idx)
+
+
+class Prefetcher(object):
+  """Prepare items in a background thread so they are ready when needed.
+
+  This is used to overlap building the next batch & feed dict with the
+  session.run on the current one. The time spent blocked in Get is
+  accumulated in wait_time.
+  """
+
+  def __init__(self, produce, depth=4):
+    """
+    Args:
+      produce: function that returns the next item, called repeatedly
+      depth: maximum number of items to prepare ahead of time, if zero the
+        items are made on demand in Get
+    """
+    self.wait_time = 0.0
+    self._produce = produce
+    self._thread = None
+    if depth > 0:
+      self._queue = Queue.Queue(maxsize=depth)
+      self._thread = threading.Thread(target=self._Run)
+      self._thread.daemon = True
+      self._thread.start()
+
+  def _Run(self):
+    while True:
+      try:
+        item = self._produce()
+      except Exception:  # pass the error on to the consumer
+        self._queue.put((None, sys.exc_info()))
+        return
+      self._queue.put((item, None))
+
+  def Get(self):
+    start_time = time.time()
+    if self._thread is None:
+      item, exc_info = self._produce(), None
+    else:
+      item, exc_info = self._queue.get()
+    self.wait_time += time.time() - start_time
+    if exc_info is not None:
+      raise exc_info[0], exc_info[1], exc_info[2]
+    return item
 
 
 if __name__ == '__main__':
   parser = argparse.ArgumentParser()
   parser.add_argument('--filename', default='/s0/ajaech/reddit.tsv.bz2')
   parser.add_argument('--out')
+  parser.add_argument('--convert', action='store_true',
+                      help='convert the file to the faster {0} format'.format(
+                        CHUNK_FILE_SUFFIX))
+  parser.add_argument('--workers', type=int, default=1,
+                      help='threads for decompressing the input')
   args = parser.parse_args()
 
-  data = ReadData(args.filename, columns=None, limit=None)
+  if args.convert:
+    out = args.out or re.sub(r'(\.tsv)?(\.bz2|\.gz)?$', CHUNK_FILE_SUFFIX,
+                             args.filename, count=1)
+    WriteChunkFile(args.filename, out, num_workers=args.workers)
+    sys.exit(0)
+
+  data = ReadData(args.filename, columns=None, limit=None,
+                  num_workers=args.workers)
   usernames = data[0]
   texts = data[2].apply(NgramSplitter)
   with open(args.out, 'w') as f:
@@ -0,0 +1,197 @@
+# decompress multi-stream bz2 and gzip files using several threads
+import bz2
+import collections
+import re
+import zlib
+from multiprocessing.pool import ThreadPool
+
+
+# Files written by pbzip2, pigz --independent or plain concatenation are made
+# of many independent streams. A stream starts at a byte boundary with one of
+# these headers, so the file can be cut there and the pieces decompressed in
+# parallel. The bz2 and zlib modules release the GIL, so threads are enough.
+STREAM_STARTS = {
+  'bz2': re.compile(r'BZh[1-9]1AY&SY'),
+  'gz': re.compile(r'\x1f\x8b\x08[\x00-\x1f]')
+}
+
+
+def _NewDecompressor(kind):
+  if kind == 'bz2':
+    return bz2.BZ2Decompressor()
+  return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+def DecompressStreams(kind, data):
+  """Decompress a run of complete streams.
+
+  Returns None if the data does not end exactly at the end of a stream,
+  e.g. because a stream header was matched inside compressed data.
+  """
+  data += '\0'  # anything left over after the last stream ends
+  out = []
+  try:
+    while data != '\0':
+      d = _NewDecompressor(kind)
+      out.append(d.decompress(data))
+      if not d.unused_data:  # the last stream is incomplete
+        return None
+      data = d.unused_data
+  except (IOError, EOFError, ValueError, zlib.error):
+    return None
+  return ''.join(out)
+
+
+def _StreamEnded(d):
+  """Whether the decompressor has seen the end of its stream."""
+  if d.unused_data:
+    return True
+  # there is no eof attribute in python 2, so feed one more byte: it is
+  # rejected or left unused after the end and decoded or buffered before
+  try:
+    d.decompress('\0')
+  except EOFError:
+    return True
+  except (IOError, ValueError, zlib.error):
+    return False
+  return bool(d.unused_data)
+
+
+def _SerialDecompress(kind, data, f, block_size):
+  """Decompress the rest of the file a block at a time in this thread.
+
+  Raises EOFError if the file ends in the middle of a stream.
+  """
+  d = _NewDecompressor(kind)
+  started = False
+  while data:
+    started = True
+    try:
+      result = d.decompress(data)
+    except EOFError:  # a bz2 stream ended exactly at the end of the last block
+      d = _NewDecompressor(kind)
+      result = d.decompress(data)
+    yield result
+    while d.unused_data:  # start of the next stream
+      data = d.unused_data
+      d = _NewDecompressor(kind)
+      yield d.decompress(data)
+    data = f.read(block_size)
+  if started and not _StreamEnded(d):
+    raise EOFError('compressed file ended before the end-of-stream marker')
+
+
+def DecompressBlocks(filename, num_workers, block_size=1 << 23):
+  """Yields the decompressed contents of a bz2 or gzip file in order.
+
+  The file is cut into pieces of about block_size bytes at stream boundaries
+  and the pieces are decompressed by num_workers threads. Files that consist
+  of a single large stream are decompressed serially.
+  """
+  kind = 'bz2' if filename.endswith('.bz2') else 'gz'
+  stream_start = STREAM_STARTS[kind]
+  pool = ThreadPool(num_workers)
+  pending = collections.deque()
+  leftover = ''  # pieces that did not decompress on their own
+
+  def Finish(segment, result):
+    # a piece that fails is retried together with the pieces after it
+    if not leftover:
+      result = result.get()
+    else:
+      segment = leftover + segment
+      result = DecompressStreams(kind, segment)
+    if result is None:
+      return segment, None
+    return '', result
+
+  try:
+    with open(filename, 'rb') as f:
+      data = ''
+      while True:
+        block = f.read(block_size)
+        if block:
+          search_from = max(1, len(data) - 16)
+          data += block
+          cut = None
+          for match in stream_start.finditer(data, search_from):
+            cut = match.start()
+          if cut is None:
+            if len(data) < 4 * block_size:
+              continue
+            break  # a single big stream, give up on parallelism
+          segment, data = data[:cut], data[cut:]
+        else:
+          segment, data = data, ''
+
+        if segment:
+          pending.append((segment, pool.apply_async(DecompressStreams,
+                                                    (kind, segment))))
+        while pending and (len(pending) > 2 * num_workers or not block):
+          leftover, result = Finish(*pending.popleft())
+          if result:
+            yield result
+        if not block:
+          break
+
+      while pending:
+        leftover, result = Finish(*pending.popleft())
+        if result:
+          yield result
+      # whatever remains is decompressed serially, which also reports errors
+      # such as a truncated file
+      for result in _SerialDecompress(kind, leftover + data, f, block_size):
+        yield result
+  finally:
+    pool.terminate()
+
+
+class BlockReader(object):
+  """A read-only file object over an iterator of strings."""
+
+  def __init__(self, blocks):
+    self._blocks = iter(blocks)
+    self._buffer = ''
+    self._pos = 0  # avoids copying the rest of a large block on each read
+
+  def _Fill(self, done):
+    self._buffer = self._buffer[self._pos:]
+    self._pos = 0
+    while not done():
+      block = next(self._blocks, None)
+      if block is None:
+        break
+      self._buffer += block
+
+  def read(self, size=-1):
+    if size < 0:
+      self._Fill(lambda: False)
+      size = len(self._buffer)
+    elif len(self._buffer) - self._pos < size:
+      self._Fill(lambda: len(self._buffer) >= size)
+    result = self._buffer[self._pos:self._pos + size]
+    self._pos += len(result)
+    return result
+
+  def readline(self):
+    end = self._buffer.find('\n', self._pos)
+    if end < 0:
+      self._Fill(lambda: '\n' in self._buffer)
+      end = self._buffer.find('\n', self._pos)
+    end = end + 1 if end >= 0 else len(self._buffer)
+    result = self._buffer[self._pos:end]
+    self._pos = end
+    return result
+
+  def __iter__(self):
+    return iter(self.readline, '')
+
+  def close(self):
+    if hasattr(self._blocks, 'close'):
+      self._blocks.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
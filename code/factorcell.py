@@ -8,13 +8,22 @@ class FactorCell(rnn_cell.RNNCell):
 
   def __init__(self, num_units, embedding_size, context_embed, 
                mikilovian_adaptation=False, lowrank_adaptation=False,
-               rank=10, layer_norm=False, dropout_keep_prob=None):
+               rank=10, layer_norm=False, dropout_keep_prob=None,
+               reset_on_input=False):
     """
     Mikilovian adaptation is a concatenation of the context embedding with
     the input to the recurrent layer.
 
     Lowrank adaptation is a context sensitive low-rank transformation of
     the recurrent layer weights.
+
+    If reset_on_input is true then the last column of the input is a flag
+    that zeros the state before the step. This is used when several
+    sentences are packed into one sequence.
+
+    Calling the cell with merged=True is for decoding, where every row uses
+    the first context. The adaptation is then folded into one weight matrix
+    and bias, see GetMergedWeights.
     """
     self._num_units = num_units
     self._forget_bias = 1.0
@@ -23,6 +32,8 @@ class FactorCell(rnn_cell.RNNCell):
     self.lowrank_adaptation = lowrank_adaptation
     self.layer_norm = layer_norm
     self._keep_prob = dropout_keep_prob
+    self.reset_on_input = reset_on_input
+    self.merged_weights = None
 
     input_size = num_units + embedding_size
 
@@ -65,6 +76,58 @@ class FactorCell(rnn_cell.RNNCell):
           'mikolov_biases', [context_embed_size, 3 * self._num_units])
         self.delta = tf.matmul(context_embed, self.biases)
 
+  def GetMergedWeights(self):
+    """Weights and bias with the first context's adaptation folded in.
+
+    These are computed by the first step and can be fed to the later steps
+    with the same context to skip the low-rank products.
+    """
+    if self.merged_weights is None:
+      W = self.W
+      if self.lowrank_adaptation:
+        W += tf.matmul(self.left_adapt[0], self.right_adapt[0])
+      bias = self.bias
+      if self.mikilov_adapt:
+        bias += self.delta[0]
+      self.merged_weights = (tf.identity(W, name='merged_W'),
+                             tf.identity(bias, name='merged_bias'))
+    return self.merged_weights
+
+  def _GateInputs(self, the_input, merged):
+    """The input to the gates before layer norm and nonlinearities."""
+    if merged:
+      W, bias = self.GetMergedWeights()
+      return tf.matmul(the_input, W) + bias
+
+    result = tf.matmul(the_input, self.W)
+
+    if self.lowrank_adaptation:
+      input_expanded = tf.expand_dims(the_input, 1)
+      intermediate = tf.matmul(input_expanded, self.left_adapt)
+      final = tf.matmul(intermediate, self.right_adapt)
+      result += tf.squeeze(final, [1])
+    if self.mikilov_adapt:
+      result += self.delta
+
+    return result + self.bias
+
+  def _Gates(self, result):
+    """Splits the gates and applies layer norm and the forget bias."""
+    j, f, o = tf.split(axis=1, num_or_size_splits=3, value=result)
+
+    def Norm(inputs, gamma, beta):
+      # layer norm helper function
+      m, v = tf.nn.moments(inputs, [1], keep_dims=True)
+      normalized_input = (inputs - m) / tf.sqrt(v + 1e-5)
+      return normalized_input * gamma + beta
+
+    if self.layer_norm:     
+      j = Norm(j, self.gammas[0], self.betas[0])
+      f = Norm(f, self.gammas[1], self.betas[1])
+      o = Norm(o, self.gammas[2], self.betas[2])
+
+    return j, f + self._forget_bias, o
+
   def __str__(self):
     return 'factor cell of size {0}'.format(self._num_units)
 
@@ -76,37 +139,20 @@ class FactorCell(rnn_cell.RNNCell):
   def output_size(self):
     return self._num_units
 
-  def __call__(self, inputs, state, scope=None, reuse=None):
+  def __call__(self, inputs, state, scope=None, reuse=None, merged=False):
     with tf.variable_scope("hyper_lstm_cell", reuse=reuse):
       # Parameters of gates are concatenated into one multiply for efficiency.
       c, h = state
+      if self.reset_on_input:
+        keep = 1.0 - inputs[:, -1:]
+        inputs = inputs[:, :-1]
+        c *= keep
+        h *= keep
       the_input = tf.concat(axis=1, values=[inputs, h])
       
-      result = tf.matmul(the_input, self.W)
-
-      if self.lowrank_adaptation:
-        input_expanded = tf.expand_dims(the_input, 1)
-        intermediate = tf.matmul(input_expanded, self.left_adapt)
-        final = tf.matmul(intermediate, self.right_adapt)
-        result += tf.squeeze(final)
-      if self.mikilov_adapt:
-        result += self.delta
-
-      result += self.bias
-
+      result = self._GateInputs(the_input, merged)
       # j = new_input, f = forget_gate, o = output_gate
-      j, f, o = tf.split(axis=1, num_or_size_splits=3, value=result)
-
-      def Norm(inputs, gamma, beta):
-        # layer norm helper function
-        m, v = tf.nn.moments(inputs, [1], keep_dims=True)
-        normalized_input = (inputs - m) / tf.sqrt(v + 1e-5)
-        return normalized_input * gamma + beta
-
-      if self.layer_norm:     
-        j = Norm(j, self.gammas[0], self.betas[0])
-        f = Norm(f, self.gammas[1], self.betas[1])
-        o = Norm(o, self.gammas[2], self.betas[2])
+      j, f, o = self._Gates(result)
 
       g = self._activation(j)
 
@@ -114,7 +160,7 @@ class FactorCell(rnn_cell.RNNCell):
       if (not isinstance(self._keep_prob, float)) or self._keep_prob < 1:
         g = tf.nn.dropout(g, self._keep_prob)
 
-      forget_gate = tf.sigmoid(f + self._forget_bias)
+      forget_gate = tf.sigmoid(f)
       input_gate = 1.0 - forget_gate  # input and forget gates are coupled
 
       new_c = (c * forget_gate + input_gate * g)
@@ -122,3 +168,56 @@ class FactorCell(rnn_cell.RNNCell):
 
       new_state = rnn_cell.LSTMStateTuple(new_c, new_h)
       return new_h, new_state
+
+
+class FusedFactorCell(FactorCell):
+  """FactorCell that runs fewer ops per step.
+
+  It has the same variables and computes the same function. Everything
+  that does not change between steps (the Mikolov bias, the forget bias,
+  the stacked layer norm parameters) is prepared once when the cell is
+  created and the three gates are layer normalized together.
+  """
+
+  def __init__(self, *args, **kwargs):
+    super(FusedFactorCell, self).__init__(*args, **kwargs)
+    n = self._num_units
+
+    with tf.variable_scope('factor_cell'):
+      # added to the forget gate before the sigmoid
+      gate_offset = tf.constant([0.0] * n + [self._forget_bias] * n + [0.0] * n)
+
+      self.step_bias = self.bias
+      if self.mikilov_adapt:
+        self.step_bias += self.delta
+      if self.layer_norm:
+        self.stacked_gammas = tf.stack(self.gammas)
+        self.stacked_betas = tf.stack(self.betas) + tf.reshape(gate_offset, [3, n])
+        self.gate_offset = 0.0
+      else:
+        self.step_bias += gate_offset
+        self.gate_offset = gate_offset
+
+  def __str__(self):
+    return 'fused factor cell of size {0}'.format(self._num_units)
+
+  def _GateInputs(self, the_input, merged):
+    if merged:
+      W, bias = self.GetMergedWeights()
+      return tf.matmul(the_input, W) + (bias + self.gate_offset)
+
+    result = tf.matmul(the_input, self.W) + self.step_bias
+    if self.lowrank_adaptation:
+      low_rank = tf.matmul(tf.matmul(tf.expand_dims(the_input, 1), self.left_adapt),
+                           self.right_adapt)
+      result += tf.squeeze(low_rank, [1])
+    return result
+
+  def _Gates(self, result):
+    gates = tf.reshape(result, [-1, 3, self._num_units])
+    if self.layer_norm:
+      centered = gates - tf.reduce_mean(gates, 2, keep_dims=True)
+      variance = tf.reduce_mean(tf.square(centered), 2, keep_dims=True)
+      gates = (centered * tf.rsqrt(variance + 1e-5) * self.stacked_gammas +
+               self.stacked_betas)
+    return tf.unstack(gates, axis=1)
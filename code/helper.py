@@ -1,5 +1,8 @@
 import bunch
+import collections
+import itertools
 import json
+import multiprocessing
 import os
 from math import radians, cos, sin, asin, sqrt
 
@@ -18,6 +21,64 @@ def GetParams(filename, mode, expdir):
   return params
 
 
+def ChunkedMap(func, items, num_workers=1, chunksize=10000, pool=None):
+  """Apply func to successive lists of items, using a process pool if num_workers > 1.
+
+  The results are yielded in order, one per chunk. func must be picklable,
+  i.e. a module level function or a functools.partial of one. At most
+  2 * num_workers chunks are read ahead of the consumer. A pool that is
+  passed in is reused and left running, otherwise one is made for the call.
+  """
+  iterator = iter(items)
+  chunks = iter(lambda: list(itertools.islice(iterator, chunksize)), [])
+  if num_workers <= 1:
+    for chunk in chunks:
+      yield func(chunk)
+    return
+
+  own_pool = pool is None
+  if own_pool:
+    pool = multiprocessing.Pool(num_workers)
+  pending = collections.deque()
+  try:
+    for chunk in chunks:
+      pending.append(pool.apply_async(func, (chunk,)))
+      if len(pending) > 2 * num_workers:
+        yield pending.popleft().get()
+    while pending:
+      yield pending.popleft().get()
+  finally:
+    if own_pool:
+      pool.terminate()
+
+
+class LRUCache(object):
+  """Dictionary that keeps only the max_size most recently used items."""
+
+  def __init__(self, max_size=100):
+    self.max_size = max_size
+    self._items = collections.OrderedDict()
+
+  def __contains__(self, key):
+    return key in self._items
+
+  def __len__(self):
+    return len(self._items)
+
+  def Get(self, key, default=None):
+    if key not in self._items:
+      return default
+    value = self._items.pop(key)
+    self._items[key] = value  # move to the end
+    return value
+
+  def Put(self, key, value):
+    self._items.pop(key, None)
+    self._items[key] = value
+    if len(self._items) > self.max_size:
+      self._items.popitem(last=False)
+
+
 def haversine(lon1, lat1, lon2, lat2):
     """
     Calculate the great circle distance between two points 
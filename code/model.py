@@ -3,13 +3,41 @@ import numpy as np
 import tensorflow as tf
 from tensorflow.python.ops import rnn_cell
 
-from factorcell import FactorCell
+from factorcell import FactorCell, FusedFactorCell
 import nn_impl
 
 
 np.random.seed(666)
 
 
+def HashKeyOffsets(context_vars, context_vocabs):
+  """Gives each categorical context variable its own range of context ids."""
+  offsets = {}
+  num_contexts = 0
+  for c_var in context_vars:
+    if context_vocabs[c_var]:
+      offsets[c_var] = num_contexts
+      num_contexts += len(context_vocabs[c_var])
+  return offsets
+
+
+def BuildHashEntries(data, context_vars, context_vocabs, vocab_size,
+                     chunksize=100000):
+  """Find the (context, word) pairs that occur in a prepared dataset.
+
+  Returns the sorted hash keys of the pairs, see GetHashFunc.
+  """
+  offsets = HashKeyOffsets(context_vars, context_vocabs)
+  keys = [np.zeros(0, dtype=np.int64)]
+  for start in xrange(0, len(data), chunksize):
+    text = data.text[start:start + chunksize].astype(np.int64)
+    for c_var in offsets:
+      contexts = data[c_var][start:start + chunksize].astype(np.int64)
+      context_keys = (contexts + offsets[c_var]) * vocab_size
+      keys.append(np.unique(context_keys[:, np.newaxis] + text))
+  return np.unique(np.concatenate(keys))
+
+
 class BaseModel(object):
   """Hold the code that is shared between all model varients."""
 
@@ -19,9 +47,21 @@ class BaseModel(object):
     self.max_length = params.max_len
     self.vocab_size = len(word_vocab)
     self.num_context_vars = len(context_vocab_sizes)
-    self.word_ids = tf.placeholder(tf.int64, [params.batch_size, self.max_length + 1],
-                                   name='word_ids')
-    self.seq_len = tf.placeholder(tf.int64, [params.batch_size], name='seq_len')
+    # the time dimension is left open so that batches can be trimmed to the
+    # length of their longest sentence, the batch dimension so that inference
+    # can use any batch size
+    self.word_ids = tf.placeholder(tf.int64, [None, None], name='word_ids')
+    self.seq_len = tf.placeholder(tf.int64, [None], name='seq_len')
+
+    # with packing, several sentences share a row and sentence_starts marks
+    # the position of the first token of each of them
+    self.pack_sequences = hasattr(params, 'pack_sequences') and params.pack_sequences
+    if self.pack_sequences:
+      if reverse:
+        raise ValueError('packed sequences can not be reversed')
+      self.sentence_starts = tf.placeholder_with_default(
+        tf.zeros_like(self.word_ids, dtype=tf.float32), [None, None],
+        name='sentence_starts')
 
     if reverse:  # provides the option to train a backwards language model
       word_ids_reversed = tf.reverse_sequence(self.word_ids, self.seq_len, 1)
@@ -35,6 +75,11 @@ class BaseModel(object):
     if hasattr(params, 'l1_penalty'):
       self.l1_penalty = params.l1_penalty
 
+    # the full softmax is computed this many words at a time if it is set
+    self.softmax_chunk_size = None
+    if hasattr(params, 'softmax_chunk_size'):
+      self.softmax_chunk_size = params.softmax_chunk_size
+
     enable_low_rank_adapt = (params.use_mikolov_adaptation or params.use_lowrank_adaptation or
                              params.use_softmax_adaptation)
     if enable_low_rank_adapt or params.use_hash_table or params.use_context_dependent_bias:
@@ -100,44 +145,46 @@ class BaseModel(object):
     self.dropout_keep_prob = tf.placeholder_with_default(1.0, (), name='keep_prob')
     
     # Make a mask to delete the padding
-    indicator = tf.sequence_mask(tf.to_int32(self.seq_len - 1), self.max_length)
+    self.batch_size = tf.shape(self.y)[0]
+    self.num_steps = tf.shape(self.y)[1]
+    indicator = tf.sequence_mask(tf.to_int32(self.seq_len - 1), self.num_steps)
     if exclude_unk:
       indicator = tf.logical_and(indicator, tf.not_equal(self.y, 0))
-    sz = [params.batch_size, self.max_length]
-    self._mask = tf.where(indicator, tf.ones(sz), tf.zeros(sz))
+    if self.pack_sequences:  # don't predict across sentence boundaries
+      indicator = tf.logical_and(indicator, tf.equal(self.sentence_starts[:, 1:], 0))
+    self._mask = tf.to_float(indicator)
 
   def OutputHelper(self, reshaped_outputs, params, use_nce_loss=True, hash_func=None):
     self.cost = 0.0  # default cost value
+    # with softmax adaptation the first columns of the output embeddings are
+    # scored against the context embedding, once per sentence
+    context_embed = None
+    if params.use_softmax_adaptation:
+      context_embed = self.final_context_embed
+
     if use_nce_loss:
       # proj_out will be batch_size x max_len x k
-      proj_out =  tf.reshape(reshaped_outputs, [self._mask.get_shape()[0].value,
-                                                self._mask.get_shape()[1].value, -1])
-      # add in the context embeddings
-      if params.use_softmax_adaptation:
-        packed_context_embed = tf.stack([self.final_context_embed] * params.max_len, 1)
-        proj_out = tf.concat(axis=2, values=[packed_context_embed, proj_out])
-
+      proj_out =  tf.reshape(reshaped_outputs, [self.batch_size, self.num_steps, -1])
       losses, l1_losses = self.AltNCE(proj_out, self.word_embedder.GetEmbeddings,
-                                      params.nce_samples, hash_func)
+                                      params.nce_samples, hash_func,
+                                      context_embed=context_embed)
       self.l1_loss = self.l1_penalty * tf.reduce_mean(l1_losses)
       self.cost = self.l1_loss
       
       masked_loss = tf.multiply(losses, self._mask)
     else:
-      # add in the context embeddings
-      if params.use_softmax_adaptation:
-        packed_context_embed = tf.stack([self.final_context_embed] * params.max_len, 1)
-        reshaped_context = tf.reshape(packed_context_embed, [tf.shape(reshaped_outputs)[0], -1])
-        reshaped_outputs = tf.concat(axis=1, values=[reshaped_context, reshaped_outputs])
+      masked_loss = self.ComputeLoss(reshaped_outputs, hash_func=hash_func,
+                                     context_embed=context_embed)
 
-
-      masked_loss = self.ComputeLoss(reshaped_outputs, hash_func=hash_func)
-
-    self.per_word_loss = tf.reshape(masked_loss, [-1, self.max_length])
+    self.per_word_loss = tf.reshape(masked_loss, [-1, self.num_steps])
     self.per_sentence_loss = tf.div(tf.reduce_sum(self.per_word_loss, 1),
                                     tf.reduce_sum(self._mask, 1))
 
-    self.cost += tf.reduce_sum(masked_loss) / tf.reduce_sum(self._mask)    
+    # eval sums these over the whole dataset so the perplexity doesn't depend
+    # on how the sentences are batched
+    self.total_loss = tf.reduce_sum(masked_loss)
+    self.num_words = tf.reduce_sum(self._mask)
+    self.cost += self.total_loss / self.num_words
 
   def _GetSample(self, true_classes, num_sampled):
     """Helper function for sampled softmax loss."""
@@ -148,42 +195,28 @@ class BaseModel(object):
       unique=True,
       range_max=self.vocab_size)
 
-  def AltNCE(self, weights, EmbeddingGetter, num_sampled, hash_func):
+  def AltNCE(self, weights, EmbeddingGetter, num_sampled, hash_func,
+             context_embed=None):
     """This is the version of NCE that is compatible with the feature hashing.
 
     To make it work, the sampling is done per sentence rather than per time-step.
+    Only the sampling loops over the sentences, the logits for the whole batch
+    are computed with batched matmuls.
     """
-    losses = []
-    w_unpack = tf.unstack(weights, axis=0)
-    y_unpack = tf.unstack(self.y, axis=0)
-
-    # first get all the samples
-    y_expanded = []
-    self.sampled_values = []
-    for y in y_unpack:
-      y_expand = tf.expand_dims(y, 1)
-      y_expanded.append(y_expand)
-      sampled_values = self._GetSample(y_expand, num_sampled)
-      self.sampled_values.append(sampled_values)
-
-    l1_losses = []
-    for idx, (w, y_expand, sampled_vals) in enumerate(zip(w_unpack, y_expanded,
-                                                          self.sampled_values)):
-      h_func = None
-      if hash_func is not None:
-        context_var_dict = {c_var: self.context_placeholders[c_var][idx] 
-                            for c_var in self.context_placeholders.keys()}
-        h_func = lambda(x): hash_func(x, context_var_dict)
-
-      nce_loss, l1_loss = nn_impl.sampled_softmax_loss(EmbeddingGetter, self.base_bias,
-                                                       y_expand, w, num_sampled, self.vocab_size,
-                                                       sampled_values=sampled_vals,
-                                                       hash_func=h_func)
-      l1_losses.append(l1_loss)
-      losses.append(nce_loss)
-    return tf.stack(losses, 0), l1_losses
-
-  def ComputeLoss(self, reshaped_outputs, hash_func=None):
+    # first get all the samples, the tensors can be fed to reuse them
+    self.sampled_values = tf.map_fn(
+      lambda y: tuple(self._GetSample(tf.expand_dims(y, 1), num_sampled)), self.y,
+      dtype=(tf.int64, tf.float32, tf.float32))
+
+    h_func = None
+    if hash_func is not None:
+      h_func = lambda(x): hash_func(x, self.context_placeholders)
+
+    return nn_impl.batched_sampled_softmax_loss(
+      EmbeddingGetter, self.base_bias, self.y, weights, self.sampled_values,
+      hash_func=h_func, sequence_inputs=context_embed)
+
+  def ComputeLoss(self, reshaped_outputs, hash_func=None, context_embed=None):
     """Computes loss without sampling (full vocabulary)."""
 
     out_embeddings = self.word_embedder.GetAllEmbeddings()
@@ -191,23 +224,35 @@ class BaseModel(object):
     reshaped_mask = tf.reshape(self._mask, [-1])
     reshaped_labels = tf.reshape(self.y, [-1])
 
+    if self.softmax_chunk_size and self.softmax_chunk_size < self.vocab_size:
+      reshaped_loss = self.ComputeChunkedLoss(reshaped_outputs, out_embeddings,
+                                              hash_func, context_embed)
+      return tf.multiply(reshaped_loss, reshaped_mask)
+
     bias = self.base_bias
     if hasattr(self, 'adapted_bias'):
       bias += self.adapted_bias
-    reshaped_logits = tf.matmul(
-      reshaped_outputs, out_embeddings, transpose_b=True) + bias
 
+    # one [batch_size, vocab_size] bias per sentence, broadcast over the
+    # time steps rather than tiled
+    sentence_bias = []
     if hash_func is not None:
-      all_ids = tf.range(0, self.vocab_size)
-      hash_vals = []
-      for idx in range(self.x.get_shape()[0]):  # loop over batch_size
-        context_var_dict = {c_var: self.context_placeholders[c_var][idx] 
-                            for c_var in self.context_placeholders.keys()}
-        hash_vals.append(hash_func(all_ids, context_var_dict))
-      hash_vals = tf.stack(hash_vals)
-      expanded_hash_vals = tf.stack([hash_vals] * self.max_length, 1)
-      reshaped_hash_vals = tf.reshape(expanded_hash_vals, [-1, self.vocab_size])
-      reshaped_logits += reshaped_hash_vals
+      sentence_bias.append(hash_func(self.all_ids, self.context_placeholders))
+    if context_embed is not None:
+      context_size = context_embed.get_shape()[1].value
+      sentence_bias.append(tf.matmul(context_embed, out_embeddings[:, :context_size],
+                                     transpose_b=True))
+      out_embeddings = out_embeddings[:, context_size:]
+    reshaped_logits = tf.matmul(reshaped_outputs, out_embeddings, transpose_b=True)
+
+    if sentence_bias:
+      bias += tf.add_n(sentence_bias)
+      logits = tf.reshape(reshaped_logits,
+                          [self.batch_size, self.num_steps, self.vocab_size])
+      reshaped_logits = tf.reshape(logits + tf.expand_dims(bias, 1),
+                                   [-1, self.vocab_size])
+    else:
+      reshaped_logits += bias
     
     reshaped_loss = tf.nn.sparse_softmax_cross_entropy_with_logits(
       logits=reshaped_logits, labels=reshaped_labels)
@@ -215,6 +260,67 @@ class BaseModel(object):
 
     return masked_loss
 
+  def ComputeChunkedLoss(self, reshaped_outputs, out_embeddings, hash_func=None,
+                         context_embed=None):
+    """Same loss as ComputeLoss without holding all the logits at once.
+
+    The log normalizer is accumulated over slices of softmax_chunk_size words
+    using a running maximum, so only [batch_size * max_len, chunk_size]
+    logits exist at any time.
+    """
+    chunk_size = self.softmax_chunk_size
+    outputs = tf.reshape(reshaped_outputs,
+                         [self.batch_size, self.num_steps, -1])
+    if context_embed is not None:
+      context_size = context_embed.get_shape()[1].value
+      context_embeddings = out_embeddings[:, :context_size]
+      out_embeddings = out_embeddings[:, context_size:]
+
+    def ChunkLogits(start):
+      """Logits for the words start, ..., start + chunk_size - 1."""
+      end = tf.minimum(start + chunk_size, self.vocab_size)
+      bias = self.base_bias[start:end]
+      if hasattr(self, 'adapted_bias'):
+        bias += self.adapted_bias[start:end]
+      logits = tf.matmul(reshaped_outputs, out_embeddings[start:end],
+                         transpose_b=True)
+      logits = tf.reshape(logits + bias, [self.batch_size, self.num_steps, -1])
+      if hash_func is not None:
+        ids = tf.range(start, end)
+        logits += tf.expand_dims(hash_func(ids, self.context_placeholders), 1)
+      if context_embed is not None:
+        logits += tf.expand_dims(tf.matmul(
+          context_embed, context_embeddings[start:end], transpose_b=True), 1)
+      return logits
+
+    def Body(start, running_max, running_sum):
+      logits = ChunkLogits(start)
+      new_max = tf.maximum(running_max, tf.reduce_max(logits, 2))
+      running_sum = (running_sum * tf.exp(running_max - new_max) +
+                     tf.reduce_sum(tf.exp(logits - tf.expand_dims(new_max, 2)), 2))
+      return start + chunk_size, new_max, running_sum
+
+    shape = [self.batch_size, self.num_steps]
+    _, max_logit, sum_exp = tf.while_loop(
+      lambda start, *_: start < self.vocab_size, Body,
+      [tf.constant(0), tf.fill(shape, -np.inf), tf.zeros(shape)])
+    log_norm = max_logit + tf.log(sum_exp)
+
+    # the logits of the correct words
+    true_logits = tf.reduce_sum(
+      outputs * tf.nn.embedding_lookup(out_embeddings, self.y), 2)
+    true_logits += tf.gather(self.base_bias, self.y)
+    if hasattr(self, 'adapted_bias'):
+      true_logits += tf.gather(self.adapted_bias, self.y)
+    if hash_func is not None:
+      true_logits += hash_func(self.y, self.context_placeholders)
+    if context_embed is not None:
+      true_logits += tf.reduce_sum(
+        tf.expand_dims(context_embed, 1) *
+        tf.nn.embedding_lookup(context_embeddings, self.y), 2)
+
+    return tf.reshape(log_norm - true_logits, [-1])
+
   def CreateDecodingGraph(self, params):
     """Construct the part of the graph used for decoding."""
 
@@ -228,36 +334,33 @@ class BaseModel(object):
                                   collections=[tf.GraphKeys.LOCAL_VARIABLES])
     self.temperature = tf.placeholder_with_default([1.0], [1])
 
-    # lookup embedding
-    prev_embed = tf.nn.embedding_lookup(out_embeddings, self.prev_word)
-    prev_embed = tf.expand_dims(prev_embed, 0)
-
-    if params.use_softmax_adaptation:
-      prev_embed = prev_embed[:, self.context_size:]
-
-    # one iteration of recurrent layer
-    state = rnn_cell.LSTMStateTuple(self.prev_c, self.prev_h)
-    with tf.variable_scope('RNN', reuse=True):
-      result, (self.next_c, self.next_h) = self.cell(prev_embed, state)
+    # decoding uses a single context so the adapted weights are merged and
+    # can be fed back for the next steps
+    self.merged_weights = []
+    if params.use_mikolov_adaptation or params.use_lowrank_adaptation:
+      self.merged_weights = list(self.cell.GetMergedWeights())
 
-    proj_result = tf.matmul(result, self.linear_proj)
-    if params.use_softmax_adaptation:
-      proj_result = tf.concat(axis=1, values=[self.final_context_embed, proj_result])
-      
-    # softmax layer
-    bias = self.base_bias
-    if params.use_hash_table or params.use_context_dependent_bias:
-      hval = self.hash_func(self.all_ids, self.context_placeholders)
-      bias += hval
+    logits, self.next_c, self.next_h = self.DecodeStep(
+      params, out_embeddings, tf.expand_dims(self.prev_word, 0),
+      self.prev_c, self.prev_h)
 
     self.beam_size = tf.placeholder_with_default(1, (), name='beam_size')
-    logits = tf.matmul(proj_result, out_embeddings, transpose_b=True) + bias
     self.next_prob = tf.nn.softmax(logits / self.temperature)
     #self.selected = tf.multinomial(logits / self.temperature, self.beam_size)
     self.selected = tf.squeeze(tf.multinomial(logits / self.temperature, self.beam_size))
     self.selected, _ = tf.unique(self.selected)
     self.selected_p = tf.nn.embedding_lookup(tf.transpose(self.next_prob), self.selected)
     
+    # batched step for beam search, each row is one hypothesis and gets the
+    # beam_size most likely next words
+    self.beam_words = tf.placeholder(tf.int32, [None], name='beam_words')
+    self.beam_c = tf.placeholder(tf.float32, [None, params.cell_size], name='beam_c')
+    self.beam_h = tf.placeholder(tf.float32, [None, params.cell_size], name='beam_h')
+    beam_logits, self.beam_next_c, self.beam_next_h = self.DecodeStep(
+      params, out_embeddings, self.beam_words, self.beam_c, self.beam_h)
+    self.beam_log_probs, self.beam_next_words = tf.nn.top_k(
+      tf.nn.log_softmax(beam_logits), self.beam_size)
+
     assign1 = self.prev_c.assign(self.next_c)
     assign2 = self.prev_h.assign(self.next_h)
     self.assign_op = tf.group(assign1, assign2)
@@ -267,6 +370,39 @@ class BaseModel(object):
     assign2 = self.prev_h.assign(tf.zeros_like(self.prev_h))
     self.reset_state = tf.group(assign1, assign2)
 
+  def DecodeStep(self, params, out_embeddings, prev_words, prev_c, prev_h):
+    """One step of the decoder for a batch of words that share a context.
+
+    Returns the logits and the next c and h states.
+    """
+    prev_embed = tf.nn.embedding_lookup(out_embeddings, prev_words)
+    if params.use_softmax_adaptation:
+      prev_embed = prev_embed[:, self.context_size:]
+    if self.pack_sequences:
+      prev_embed = tf.concat(axis=1, values=[prev_embed,
+                                             tf.zeros_like(prev_embed[:, :1])])
+
+    # one iteration of recurrent layer
+    state = rnn_cell.LSTMStateTuple(prev_c, prev_h)
+    with tf.variable_scope('RNN', reuse=True):
+      result, (next_c, next_h) = self.cell(prev_embed, state,
+                                           merged=len(self.merged_weights) > 0)
+
+    proj_result = tf.matmul(result, self.linear_proj)
+
+    # softmax layer, the context terms are computed once for all the rows
+    bias = self.base_bias
+    if params.use_softmax_adaptation:
+      bias += tf.matmul(self.final_context_embed,
+                        out_embeddings[:, :self.context_size], transpose_b=True)
+      out_embeddings = out_embeddings[:, self.context_size:]
+    if params.use_hash_table or params.use_context_dependent_bias:
+      hval = self.hash_func(self.all_ids, self.context_placeholders)
+      bias += hval
+
+    logits = tf.matmul(proj_result, out_embeddings, transpose_b=True) + bias
+    return logits, next_c, next_h
+
 
 class HyperModel(BaseModel):
 
@@ -274,14 +410,6 @@ class HyperModel(BaseModel):
                exclude_unk=True, word_embedder=None):
     self.all_ids = tf.range(0, len(word_vocab))
     self.word_embedder = word_embedder
-    self.word_tensor = tf.constant(word_vocab.GetWords(), name='words')
-
-    if params.use_hash_table:
-      self.context_name_tensors = {}
-      for cname in context_vocabs:
-        if context_vocabs[cname]:
-          self.context_name_tensors[cname] = tf.constant(
-            context_vocabs[cname].GetWords(), name=cname + '_words')
 
     context_vocab_sizes = []
     for s in params.context_vars:
@@ -296,7 +424,7 @@ class HyperModel(BaseModel):
 
     self.hash_func = None  # setup the hash table
     if params.use_hash_table:
-      self.hash_func = self.GetHashFunc(params)
+      self.hash_func = self.GetHashFunc(params, word_vocab, context_vocabs)
     elif params.use_context_dependent_bias:
       self.hash_func = self.GetContextDependentBias(params, context_vocab_sizes)
 
@@ -307,18 +435,26 @@ class HyperModel(BaseModel):
     layer_norm = False
     if hasattr(params, 'use_layer_norm'):
       layer_norm = params.use_layer_norm
-    self.cell = FactorCell(params.cell_size, 
+    cell_class = FactorCell
+    if hasattr(params, 'cell_type') and params.cell_type == 'fused':
+      cell_class = FusedFactorCell  # same variables, fewer ops per step
+    self.cell = cell_class(params.cell_size, 
                            self.word_embedder.embedding_dims, 
                            context_embeds,
                            mikilovian_adaptation=params.use_mikolov_adaptation,
                            lowrank_adaptation=params.use_lowrank_adaptation,
                            rank=params.rank, 
                            dropout_keep_prob=self.dropout_keep_prob,
-                           layer_norm=layer_norm)
+                           layer_norm=layer_norm,
+                           reset_on_input=self.pack_sequences)
 
     self.linear_proj = tf.get_variable(
       'linear_proj', [params.cell_size, self.word_embedder.embedding_dims])
-    outputs, _ = tf.nn.dynamic_rnn(self.cell, self._inputs, dtype=tf.float32,
+    rnn_inputs = self._inputs
+    if self.pack_sequences:  # the cell resets its state at each sentence start
+      rnn_inputs = tf.concat(
+        axis=2, values=[rnn_inputs, tf.expand_dims(self.sentence_starts[:, :-1], 2)])
+    outputs, _ = tf.nn.dynamic_rnn(self.cell, rnn_inputs, dtype=tf.float32,
                                    sequence_length=self.seq_len)
     reshaped_outputs = tf.reshape(outputs, [-1, params.cell_size])
     self.outputs = reshaped_outputs
@@ -329,6 +465,12 @@ class HyperModel(BaseModel):
     self.CreateDecodingGraph(params)
 
 
+  # The hash functions take word ids and a dict with a vector of context ids
+  # for each context variable. If the word ids are a vector, the same ids are
+  # used for every sentence and the result is [num_sentences, num_ids]. If
+  # they are a matrix, row i holds the ids for sentence i and the result has
+  # the same shape as the ids.
+
   def GetContextDependentBias(self, params, context_vocab_sizes):
     self.bias_tables = {}
     for context_var, size in zip(params.context_vars, context_vocab_sizes):
@@ -344,36 +486,57 @@ class HyperModel(BaseModel):
 
         # first lookup the ids
         selected_ids = tf.nn.embedding_lookup(bias_table, ids)
-        result += tf.nn.embedding_lookup(tf.transpose(selected_ids),
-                                         s_ids[c_var])
+        if ids.get_shape().ndims == 1:
+          result += tf.nn.embedding_lookup(tf.transpose(selected_ids),
+                                           s_ids[c_var])
+        else:  # pick each sentence's column, one_hot keeps the gradient sparse
+          context_mask = tf.one_hot(s_ids[c_var], bias_table.get_shape()[1].value)
+          result += tf.reduce_sum(selected_ids * tf.expand_dims(context_mask, 1), 2)
       return result
 
     self.HashGetter = GetBias
     return GetBias
 
-  def GetHashFunc(self, params):
-    """Returns a function that hashes context & unigrams."""
-
-    entries = []
-    with gzip.open(params.hash_entries_filename, 'r') as f:
-      for line in f:
-        entries.append(line.strip())
+  def GetHashFunc(self, params, word_vocab, context_vocabs):
+    """Returns a function that hashes context & unigrams.
 
+    The (context, word) pairs are looked up by the integer key
+    (context offset + context id) * vocab size + word id, where the offsets
+    give each context variable its own range of ids.
+    """
+    offsets = HashKeyOffsets(params.context_vars, context_vocabs)
+    if params.hash_entries_filename.endswith('.npy'):
+      # sorted keys, the value of a key is its position
+      keys = np.load(params.hash_entries_filename, mmap_mode='r')
+      values = np.arange(1, len(keys) + 1, dtype=np.int64)
+      num_entries = len(keys)
+    else:
+      keys, values, num_entries = self._ReadHashEntries(
+        params.hash_entries_filename, word_vocab, context_vocabs, offsets)
+
+    # the entries are fed when the table is initialized to keep them out of
+    # the graph definition
+    self._hash_entries = (keys, values)
+    self._hash_table_session = None
+    self._hash_keys = tf.placeholder(tf.int64, [None], name='hash_keys')
+    self._hash_values = tf.placeholder(tf.int64, [None], name='hash_values')
     self.myhash = tf.contrib.lookup.HashTable(
       tf.contrib.lookup.KeyValueTensorInitializer(
-        entries, np.arange(1, len(entries) + 1),
-        key_dtype=tf.string, value_dtype=tf.int32), 0)
-    self.aux_hash_table = tf.Variable(np.zeros(len(entries) + 1),
+        self._hash_keys, self._hash_values,
+        key_dtype=tf.int64, value_dtype=tf.int64), 0)
+    self.aux_hash_table = tf.Variable(np.zeros(num_entries + 1),
                                       dtype=tf.float32, name='aux_hash_table')
 
     def GetHash(ids, s_ids):
-      words = tf.nn.embedding_lookup(self.word_tensor, ids)
+      ids = tf.to_int64(ids)
       
       result = 0.0
       for c_var in s_ids.keys():
-        context_names = tf.nn.embedding_lookup(self.context_name_tensors[c_var],
-                                               s_ids[c_var])
-        key = tf.string_join([words, context_names], separator='~')
+        if c_var not in offsets:
+          continue  # numerical context
+        context_keys = (tf.to_int64(s_ids[c_var]) + offsets[c_var]) * self.vocab_size
+        # broadcasting gives [num_sentences, num_ids] for both shapes of ids
+        key = tf.expand_dims(context_keys, 1) + ids
         val = self.myhash.lookup(key)
         aux_val = tf.nn.embedding_lookup(self.aux_hash_table, val)
 
@@ -385,3 +548,33 @@ class HyperModel(BaseModel):
 
     self.HashGetter = GetHash
     return GetHash
+
+  def _ReadHashEntries(self, filename, word_vocab, context_vocabs, offsets):
+    """Read the 'word~context' lines written by older versions.
+
+    The value of a line is its position. A line is entered for each context
+    variable that has the context name.
+    """
+    keys = []
+    values = []
+    num_entries = 0
+    with gzip.open(filename, 'r') as f:
+      for num_entries, line in enumerate(f, 1):
+        word, context_name = line.strip().rsplit('~', 1)
+        if word not in word_vocab:
+          continue
+        for c_var in offsets:
+          if context_name in context_vocabs[c_var]:
+            context_id = offsets[c_var] + context_vocabs[c_var][context_name]
+            keys.append(context_id * self.vocab_size + word_vocab[word])
+            values.append(num_entries)
+    return (np.array(keys, dtype=np.int64), np.array(values, dtype=np.int64),
+            num_entries)
+
+  def InitHashTable(self, session):
+    if self._hash_table_session is session:  # a table can only be initialized once
+      return
+    keys, values = self._hash_entries
+    session.run(self.myhash.init, {self._hash_keys: keys,
+                                   self._hash_values: values})
+    self._hash_table_session = session
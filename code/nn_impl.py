@@ -297,3 +297,96 @@ def sampled_softmax_loss(weights,
                                                             logits=logits)
   # sampled_losses is a [batch_size] tensor.
   return sampled_losses, l1_cost
+
+
+def batched_sampled_softmax_loss(weights,
+                                 biases,
+                                 labels,
+                                 inputs,
+                                 sampled_values,
+                                 remove_accidental_hits=True,
+                                 hash_func=None,
+                                 sequence_inputs=None,
+                                 name="batched_sampled_softmax_loss"):
+  """Sampled softmax loss with a separate set of samples for each sequence.
+
+  Computes the same losses as calling `sampled_softmax_loss` once per
+  sequence, but for the whole batch at once using batched matmuls.
+
+  Args:
+    weights: A function that maps a `Tensor` of class ids to their
+        embeddings, adding a trailing dimension of size `dim`.
+    biases: A `Tensor` of shape `[num_classes]`.  The class biases.
+    labels: A `Tensor` of shape `[batch_size, num_steps]`. The target classes.
+    inputs: A `Tensor` of shape `[batch_size, num_steps, dim]`.
+    sampled_values: a tuple of (`sampled_candidates`, `true_expected_count`,
+        `sampled_expected_count`) with shapes `[batch_size, num_sampled]`,
+        `[batch_size, num_steps, 1]` and `[batch_size, num_sampled]`, i.e.
+        the outputs of a `*_candidate_sampler` stacked over the sequences.
+    remove_accidental_hits:  A `bool`.  whether to remove "accidental hits"
+        where a sampled class equals the target class of a step.
+    hash_func: optional function that maps a `[batch_size, n]` `Tensor` of
+        class ids to `[batch_size, n]` extra biases for each sequence.
+    sequence_inputs: optional `Tensor` of shape `[batch_size, context_dim]`
+        that is shared by all the steps of a sequence. It is scored against
+        the first `context_dim` columns of the class embeddings once per
+        sequence, and `inputs` against the remaining ones.
+    name: A name for the operation (optional).
+
+  Returns:
+    A `[batch_size, num_steps]` tensor of per-step sampled softmax losses and
+    a `[batch_size]` tensor with the mean absolute value of the hash biases
+    used by each sequence.
+  """
+  with ops.name_scope(name, "batched_sampled_softmax_loss",
+                      [biases, inputs, labels]):
+    labels = math_ops.cast(labels, dtypes.int64)
+    sampled, true_expected_count, sampled_expected_count = sampled_values
+    sampled = math_ops.cast(sampled, dtypes.int64)
+
+    true_w = weights(labels)  # [batch_size, num_steps, dim]
+    sampled_w = weights(sampled)  # [batch_size, num_sampled, dim]
+    true_b = embedding_ops.embedding_lookup(biases, labels)
+    sampled_b = embedding_ops.embedding_lookup(biases, sampled)
+
+    if sequence_inputs is not None:
+      context_dim = sequence_inputs.get_shape()[1].value
+      expanded_inputs = array_ops.expand_dims(sequence_inputs, 1)
+      true_b += math_ops.reduce_sum(
+          expanded_inputs * true_w[:, :, :context_dim], 2)
+      sampled_b += array_ops.squeeze(math_ops.matmul(
+          expanded_inputs, sampled_w[:, :, :context_dim], transpose_b=True), [1])
+      true_w = true_w[:, :, context_dim:]
+      sampled_w = sampled_w[:, :, context_dim:]
+
+    if hash_func is not None:
+      true_hash = hash_func(labels)
+      sampled_hash = hash_func(sampled)
+      l1_cost = math_ops.reduce_mean(
+          math_ops.abs(tf.concat([true_hash, sampled_hash], axis=1)), 1)
+      true_b += true_hash
+      sampled_b += sampled_hash
+    else:
+      l1_cost = array_ops.zeros_like(true_b[:, 0])
+
+    true_logits = math_ops.reduce_sum(inputs * true_w, 2) + true_b
+    sampled_logits = math_ops.matmul(inputs, sampled_w, transpose_b=True)
+    sampled_logits += array_ops.expand_dims(sampled_b, 1)
+
+    if remove_accidental_hits:
+      hits = math_ops.equal(array_ops.expand_dims(labels, 2),
+                            array_ops.expand_dims(sampled, 1))
+      sampled_logits += math_ops.cast(hits, sampled_logits.dtype) * (
+          -sampled_logits.dtype.max)
+
+    # Subtract log of Q(l), prior probability that l appears in sampled.
+    true_logits -= math_ops.log(array_ops.squeeze(true_expected_count, [2]))
+    sampled_logits -= array_ops.expand_dims(
+        math_ops.log(sampled_expected_count), 1)
+
+    # The true logits are in column 0.
+    out_logits = tf.concat([array_ops.expand_dims(true_logits, 2),
+                            sampled_logits], axis=2)
+    sampled_losses = nn_ops.sparse_softmax_cross_entropy_with_logits(
+        labels=array_ops.zeros_like(labels), logits=out_logits)
+  return sampled_losses, l1_cost
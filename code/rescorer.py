@@ -27,10 +27,9 @@ param_filename = os.path.join(args.expdir, 'params.json')
 with open(param_filename, 'r') as f:
   params = bunch.Bunch(json.load(f))
 params.nce_samples = 1000
-params.batch_size = 1
 
 
-vocab = Vocab.Load(os.path.join(args.expdir, 'word_vocab.pickle'))
+vocab = Vocab.LoadSaved(args.expdir, 'word_vocab')
 with open(os.path.join(args.expdir, 'context_vocab.pickle'), 'rb') as f:
   context_vocabs = pickle.load(f)
 
@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 import argparse
 import collections
-import copy
 import gzip
 import logging
 import numpy as np
@@ -14,9 +13,9 @@ import time
 
 from beam import BeamItem, BeamQueue
 from char2vec import MikolovEmbeddings, Char2Vec
-from model import HyperModel
+from model import BuildHashEntries, HyperModel
 from vocab import Vocab
-from dataset import Dataset
+from dataset import Dataset, Prefetcher
 import helper
 import metrics
 
@@ -37,6 +36,27 @@ parser.add_argument('--valdata', type=str, action='append', dest='valdata',
 parser.add_argument('--reverse', type=bool, default=False)
 parser.add_argument('--threads', type=int, default=12,
                     help='how many threads to use in tensorflow')
+parser.add_argument('--prefetch', type=int, default=4,
+                    help='how many training batches to prepare in the background')
+parser.add_argument('--seed', type=int, default=None,
+                    help='random seed for the order of the training data')
+parser.add_argument('--workers', type=int, default=1,
+                    help='how many processes to use for tokenization and '
+                    'threads for decompression')
+parser.add_argument('--stream', action='store_true',
+                    help='stream the training data instead of loading it all')
+parser.add_argument('--shuffle_buffer', type=int, default=100000,
+                    help='number of sentences to shuffle over when streaming')
+parser.add_argument('--bucket', action='store_true',
+                    help='batch together sentences of similar lengths')
+parser.add_argument('--cache_dir', type=str, default=None,
+                    help='where to cache the datasets after converting them to ids')
+parser.add_argument('--batch_size', type=int, default=None,
+                    help='batch size for eval and classification, by default '
+                    'the training batch size')
+parser.add_argument('--softmax_chunk_size', type=int, default=None,
+                    help='compute the full softmax this many words at a time '
+                    'to save memory on large vocabularies')
 args = parser.parse_args()
 
 if not os.path.exists(args.expdir):
@@ -45,31 +65,51 @@ elif args.mode == 'train':
   print 'ERROR: expdir already exists!!!!'
   exit()
 
+if args.stream and args.mode != 'train':
+  print 'ERROR: streaming is only supported for training'
+  exit()
+
 tf.set_random_seed(int(time.time() * 1000))
 
 params = helper.GetParams(args.params, args.mode, args.expdir)
 config = tf.ConfigProto(inter_op_parallelism_threads=args.threads,
                         intra_op_parallelism_threads=args.threads)
 
+if args.stream and params.use_hash_table:
+  print 'ERROR: the hash table can not be built from streaming data'
+  exit()
+
 if not hasattr(params, 'context_var_types'):
   params.context_var_types = ['categorical'] * len(params.context_vars)
 
-if args.mode != 'train':
-  params.batch_size = 5
-if args.mode == 'debug':
-  params.batch_size = 1
+if args.mode != 'train' and args.batch_size:
+  params.batch_size = args.batch_size
+if args.softmax_chunk_size:
+  params.softmax_chunk_size = args.softmax_chunk_size
 
 SEPERATOR = ' '
 if params.splitter == 'char':
   SEPERATOR = ''
-params.hash_entries_filename = os.path.join(args.expdir, 'hash_entries.txt.gz')
+params.hash_entries_filename = os.path.join(args.expdir, 'hash_entries.npy')
+if args.mode != 'train' and not os.path.exists(params.hash_entries_filename):
+  # written by older versions
+  params.hash_entries_filename = os.path.join(args.expdir, 'hash_entries.txt.gz')
 
 if args.mode in ('train', 'eval', 'classify', 'uniclass', 'geoclass'):
   mode = args.mode
 
   dataset = Dataset(max_len=params.max_len + 1, 
                     preshuffle=args.mode=='train',
-                    batch_size=params.batch_size)
+                    batch_size=params.batch_size,
+                    streaming=args.stream,
+                    shuffle_buffer=args.shuffle_buffer,
+                    cache_dir=args.cache_dir,
+                    bucket=args.bucket,
+                    num_workers=args.workers,
+                    seed=args.seed,
+                    partial_batches=args.mode != 'train',
+                    pack=args.mode == 'train' and hasattr(params, 'pack_sequences') and
+                         params.pack_sequences)
   print 'reading data'
   dataset.ReadData(args.data, params.context_vars + ['text'],
                    splitter=params.splitter,
@@ -80,12 +120,15 @@ if args.mode == 'train':
   if args.vocab is not None:
     vocab = Vocab.Load(args.vocab)
   else:
-    vocab = Vocab.MakeFromData(dataset.GetColumn('text'), min_count=params.min_vocab_count)
+    vocab = Vocab.MakeFromCounts(
+      dataset.GetTokenCounts(), min_count=params.min_vocab_count,
+      max_size=params.vocab_max_size if hasattr(params, 'vocab_max_size') else None,
+      sort_by_count=hasattr(params, 'vocab_sort_by_count') and params.vocab_sort_by_count)
 
   if params.splitter == 'word':  # do the character vocab
     graphemes = [['{'] + Vocab.Graphemes(x) + ['}'] for x in vocab.GetWords()]
     char_vocab = Vocab.MakeFromData(graphemes, min_count=1)
-    char_vocab.Save(os.path.join(args.expdir, 'char_vocab.pickle'))
+    char_vocab.Save(os.path.join(args.expdir, 'char_vocab.vocab'))
   else:
     char_vocab = None
 
@@ -96,12 +139,12 @@ if args.mode == 'train':
       context_vocabs[context_var] = None
       continue
 
-    v = Vocab.MakeFromData([[u] for u in dataset.GetColumn(context_var)],
+    v = Vocab.MakeFromData(([u] for u in dataset.GetColumn(context_var)),
                            min_count=50, no_special_syms=True)
     context_vocabs[context_var] = v
     print 'num {0}: {1}'.format(context_var, len(v))
     
-  vocab.Save(os.path.join(args.expdir, 'word_vocab.pickle'))
+  vocab.Save(os.path.join(args.expdir, 'word_vocab.vocab'))
   print 'vocab size {0}'.format(len(vocab))
   with open(os.path.join(args.expdir, 'context_vocab.pickle'), 'wb') as f:
     pickle.dump(context_vocabs, f)
@@ -109,18 +152,13 @@ if args.mode == 'train':
   dataset.Prepare(vocab, context_vocabs)
 
   if params.use_hash_table:   # prepare the hash table
-    with gzip.open(params.hash_entries_filename, 'w') as f:
-      for context_var in params.context_vars:
-        grps = dataset.data.groupby(context_var)
-        for s_id, grp in grps:
-          unigrams = np.unique(list(grp.text.values))
-          context_name = context_vocabs[context_var][s_id]
-          for w in unigrams:
-            f.write('{0}~{1}\n'.format(vocab[w], context_name))
+    np.save(params.hash_entries_filename,
+            BuildHashEntries(dataset.data, params.context_vars, context_vocabs,
+                             len(vocab)))
 else:
-  vocab = Vocab.Load(os.path.join(args.expdir, 'word_vocab.pickle'))
+  vocab = Vocab.LoadSaved(args.expdir, 'word_vocab')
   if params.splitter == 'word':
-    char_vocab = Vocab.Load(os.path.join(args.expdir, 'char_vocab.pickle'))
+    char_vocab = Vocab.LoadSaved(args.expdir, 'char_vocab')
   else:
     char_vocab = None
   with open(os.path.join(args.expdir, 'context_vocab.pickle'), 'rb') as f:
@@ -140,7 +178,8 @@ if hasattr(params, 'embedder'):
 if embedder == 'mikolov':
   word_embedder = MikolovEmbeddings(params, vocab)
 else:
-  word_embedder = Char2Vec(params, vocab, char_vocab)
+  word_embedder = Char2Vec(params, vocab, char_vocab,
+                           cache_embeddings=args.mode != 'train')
 model = HyperModel(
   params, vocab,  context_vocabs,
   use_nce_loss=use_nce_loss, reverse=args.reverse, exclude_unk=True, 
@@ -151,17 +190,19 @@ session = tf.Session(config=config)
 
 def GetFeedDict(batch, use_dropout=True):
   # helper function to prepare feed dict for batch
-  s = np.array(list(batch.text.values))  # hacky
+  width = batch.seq_lens.max()  # trim the padding
   feed_dict = {
-    model.word_ids: s,
-    model.seq_len: batch.seq_lens.values,
+    model.word_ids: batch.text[:, :width],
+    model.seq_len: batch.seq_lens,
     model.dropout_keep_prob: params.dropout_keep_prob
   }
+  if 'starts' in batch:  # packed sequences
+    feed_dict[model.sentence_starts] = batch.starts[:, :width]
 
   if hasattr(model, 'context_placeholders'):
     for context_var in params.context_vars:
       placeholder = model.context_placeholders[context_var]
-      feed_dict[placeholder] = batch[context_var].values
+      feed_dict[placeholder] = batch[context_var]
 
   if not use_dropout:
     # if dropout is removed from feed_dict then it will be turned off
@@ -170,6 +211,13 @@ def GetFeedDict(batch, use_dropout=True):
   return feed_dict                
   
 
+def SumDuplicateRows(grad):
+  """Combine the rows of a sparse gradient that have the same index."""
+  indices, positions = tf.unique(grad.indices)
+  values = tf.unsorted_segment_sum(grad.values, positions, tf.shape(indices)[0])
+  return tf.IndexedSlices(values, indices, grad.dense_shape)
+
+
 def Train(expdir):
   """This function performs training."""
   logging.basicConfig(filename=os.path.join(expdir, 'logfile.txt'),
@@ -178,20 +226,32 @@ def Train(expdir):
 
   # have to create the optimzier after initializing the hash table
   tvars = tf.trainable_variables()
-  grads, _ = tf.clip_by_global_norm(tf.gradients(model.cost, tvars), 5.0)
-  optimizer = tf.train.AdamOptimizer(0.001)
+  grads = tf.gradients(model.cost, tvars)
+  if hasattr(params, 'sparse_updates') and params.sparse_updates:
+    # Embedding, bias table and hash table gradients stay sparse and lazy
+    # Adam only updates the rows that were used. Duplicate rows are summed
+    # first so the clipping norm is the norm of the dense gradient.
+    grads = [SumDuplicateRows(g) if isinstance(g, tf.IndexedSlices) else g
+             for g in grads]
+    optimizer = tf.contrib.opt.LazyAdamOptimizer(0.001)
+  else:
+    optimizer = tf.train.AdamOptimizer(0.001)
+  grads, _ = tf.clip_by_global_norm(grads, 5.0)
   train_op = optimizer.apply_gradients(zip(grads, tvars))
 
   print('initalizing')
   if params.use_hash_table:
-    model.myhash.init.run(session=session)
+    model.InitHashTable(session)
   session.run(tf.global_variables_initializer())
 
+  # the batches are prepared in a background thread while session.run is busy
+  prefetcher = Prefetcher(lambda: GetFeedDict(dataset.GetNextBatch(), use_dropout=True),
+                          depth=args.prefetch)
+
   avgcost = metrics.MovingAvg(0.90)
   start_time = time.time()
   for idx in xrange(params.iters):
-    batch = dataset.GetNextBatch()
-    feed_dict = GetFeedDict(batch, use_dropout=True)
+    feed_dict = prefetcher.Get()
 
     cost,  _ = session.run([model.cost, train_op], feed_dict)
     c = avgcost.Update(cost)
@@ -201,13 +261,17 @@ def Train(expdir):
       time_diff = end_time - start_time
       start_time = end_time
       seconds_per_batch = time_diff / 40
-      print 'seconds per batch {0}'.format(seconds_per_batch)
+      input_wait = prefetcher.wait_time / max(time_diff, 1e-6)
+      prefetcher.wait_time = 0.0
+      print 'seconds per batch {0} waiting for input {1:.1f}%'.format(
+        seconds_per_batch, 100.0 * input_wait)
 
       feed_dict = GetFeedDict(dataset.GetValBatch(), use_dropout=False)
       val_cost = session.run(model.cost, feed_dict)
 
       print idx, cost
-      logging.info({'iter': idx, 'cost': c, 'rawcost': cost, 'valcost': val_cost})
+      logging.info({'iter': idx, 'cost': c, 'rawcost': cost, 'valcost': val_cost,
+                    'input_wait': input_wait})
 
     if idx % 500 == 0:  # save the model every 500 minibatches
       saver.save(session, os.path.join(expdir, 'model.bin'),
@@ -244,7 +308,7 @@ def ContextBias(expdir):
 def Debug(expdir):
   metrics.PrintParams()
   if params.use_hash_table:
-    model.myhash.init.run(session=session)
+    model.InitHashTable(session)
   saver.restore(session, os.path.join(expdir, 'model.bin'))
 
   context_var = params.context_vars[0]
@@ -263,7 +327,7 @@ def Debug(expdir):
         z = session.run(table[:, context_vocab[subname]])
       else:
         z = session.run(hash_val, {context_placeholder: 
-                                   [context_vocab[subname]] * len(vocab)})
+                                   [context_vocab[subname]]})[0]
         
       vals = z.argsort()
       topwords = ['{0} {1:.2f}'.format(vocab[i], z[i]) for i in vals[-10:]]
@@ -331,6 +395,23 @@ def GetRandomSetting(feed_dict=None, fixed_context={}, print_it=False):
         feed_dict[placeholder] = np.array([context_vocab[context_settings[context_var]]])
       else:
         feed_dict[placeholder] = np.array([context_settings[context_var]])
+    FeedMergedWeights(feed_dict)
+
+
+merged_weight_cache = helper.LRUCache(max_size=64)
+def FeedMergedWeights(feed_dict):
+  # the decoder's adapted recurrent weights only depend on the context, so
+  # they are computed once per context and fed to the later steps
+  if not model.merged_weights:
+    return
+  key = tuple(feed_dict[model.context_placeholders[c]][0]
+              for c in params.context_vars)
+  values = merged_weight_cache.Get(key)
+  if values is None:
+    context_feed = dict((p, feed_dict[p]) for p in model.context_placeholders.values())
+    values = session.run(model.merged_weights, context_feed)
+    merged_weight_cache.Put(key, values)
+  feed_dict.update(zip(model.merged_weights, values))
 
 
 def InitBeam(phrase, settings):
@@ -347,6 +428,8 @@ def InitBeam(phrase, settings):
   return prev_c, prev_h
 
 def BeamSearch(expdir):
+  if params.use_hash_table:
+    model.InitHashTable(session)
   saver.restore(session, os.path.join(expdir, 'model.bin'))
 
   context = {'rating': random.choice(['5_stars', '1_stars', '2_stars', '4_stars']), 'subreddit': '5_stars',
@@ -363,41 +446,50 @@ def BeamSearch(expdir):
     '<S> we could not believe',
     '<S> when i arrived at the hotel']).split()
   beam_size = 8
+  num_candidates = 4 * beam_size  # to replace the words that are not eligible
   total_beam_size = 200
   init_c, init_h = InitBeam(starting_phrase, settings)
   nodes = [BeamItem(starting_phrase, init_c, init_h)]
+  words = vocab.GetWords()
 
   for i in xrange(80):
     new_nodes = BeamQueue(max_size=total_beam_size)
+    live_nodes = []
     for node in nodes:
       if node.words[-1] == '</S>':  # don't extend past end-of-sentence token
         new_nodes.Insert(node)
-        continue
-
-      feed_dict = {
-        model.prev_word: vocab[node.words[-1]],
-        model.prev_c: node.prev_c,
-        model.prev_h: node.prev_h,
-        model.beam_size: beam_size,
-      }
-      GetRandomSetting(feed_dict, settings, print_it=False)
-
-      current_word_id, current_word_p, node.prev_c, node.prev_h = session.run(
-        [model.selected, model.selected_p, model.next_c, model.next_h], feed_dict)
-      current_word_p = np.squeeze(current_word_p)
-      if len(current_word_p.shape) == 0:
-        current_word_p = [float(current_word_p)]
-
-      for top_entry, top_value in zip(current_word_id, current_word_p):
-        new_word = vocab[top_entry]
-        if new_word != '<UNK>' and node.IsEligible(new_word):
-          log_p = -np.log(top_value)
+      else:
+        live_nodes.append(node)
+    if not live_nodes:  # every hypothesis has ended
+      nodes = new_nodes
+      break
+
+    # advance all the hypotheses at once
+    feed_dict = {
+      model.beam_words: [vocab[node.words[-1]] for node in live_nodes],
+      model.beam_c: np.concatenate([node.prev_c for node in live_nodes]),
+      model.beam_h: np.concatenate([node.prev_h for node in live_nodes]),
+      model.beam_size: num_candidates,
+    }
+    GetRandomSetting(feed_dict, settings, print_it=False)
+    next_words, next_log_probs, next_c, next_h = session.run(
+      [model.beam_next_words, model.beam_log_probs, model.beam_next_c,
+       model.beam_next_h], feed_dict)
+
+    for parent, node in enumerate(live_nodes):
+      # the children start from the state of their parent row
+      node.prev_c = next_c[parent:parent + 1]
+      node.prev_h = next_h[parent:parent + 1]
+      num_children = 0
+      for top_entry, top_log_prob in zip(next_words[parent], next_log_probs[parent]):
+        new_word = words[top_entry]
+        if num_children < beam_size and new_word != '<UNK>' and node.IsEligible(new_word):
+          num_children += 1
+          log_p = -top_log_prob
 
           # check the bound to see if we can avoid adding this to the queue
           if new_nodes.CheckBound(log_p + node.Cost()):
-            new_beam = copy.deepcopy(node)
-            new_beam.Update(log_p, vocab[top_entry])
-            new_nodes.Insert(new_beam)
+            new_nodes.Insert(node.Extend(log_p, new_word))
     nodes = new_nodes
   for item in reversed([b for b in nodes][-4:]):
     print item.Cost(), SEPERATOR.join(item.words)
@@ -423,14 +515,14 @@ def UnigramClassify(expdir):
       print pos
     batch = dataset.GetNextBatch()
     
-    for i in xrange(len(batch)):
-      row = batch.iloc[i]
+    for text, seq_len, label in zip(batch.text, batch.seq_lens,
+                                    batch['subreddit']):
       scores = np.zeros(len(vocab_subset))
 
-      for word_id in row.text[1:row.seq_lens]:
+      for word_id in text[1:seq_len]:
         scores += log_probs[:, word_id]
       preds.append(np.argmax(scores))
-      labels.append(row['subreddit'])
+      labels.append(label)
   metrics.Metrics([lang_vocab[i] for i in preds],
                   [lang_vocab[i] for i in labels])
 
@@ -473,10 +565,11 @@ def GeoClassify(expdir):
       labels.append(closest_class)
     labels = np.array(labels)
 
+    # the batch columns may be views of the dataset, so replace, don't modify
     costs = []
     for i in range(len(names)):
-      feed_dict[model.context_placeholders['lat']][:] = classes[i]['lat']
-      feed_dict[model.context_placeholders['lon']][:] = classes[i]['lon']
+      feed_dict[model.context_placeholders['lat']] = np.full(len(batch), classes[i]['lat'])
+      feed_dict[model.context_placeholders['lon']] = np.full(len(batch), classes[i]['lon'])
       costs.append(session.run(model.per_sentence_loss, feed_dict))
     costs = np.array(costs)
 
@@ -497,8 +590,8 @@ def Classify(expdir):
   print vocab_subset
 
   print 'preparing dataset'
-  dataset.Filter(vocab_subset, context_var)
   dataset.Prepare(vocab, context_vocabs)
+  dataset.Filter(vocab_subset, context_var)
 
   results = []
   all_labels = []
@@ -508,27 +601,30 @@ def Classify(expdir):
       print pos
     batch = dataset.GetNextBatch()
     feed_dict = GetFeedDict(batch, use_dropout=False)
-    labels = np.array(feed_dict[placeholder])
+    labels = feed_dict[placeholder]
+
+    # the batch columns may be views of the dataset, so replace, don't modify
+    def SetContext(value):
+      feed_dict[placeholder] = np.full_like(labels, value)
 
     def GetCosts():
       costs = []
       if use_nce_loss:
-        feed_dict[placeholder][:] = lang_vocab[vocab_subset[0]]
-        result = session.run([model.per_sentence_loss] + model.sampled_values, feed_dict)
+        SetContext(lang_vocab[vocab_subset[0]])
+        result = session.run([model.per_sentence_loss] + list(model.sampled_values),
+                             feed_dict)
         sentence_costs, sampled_vals = result[0], result[1:]
         costs.append(sentence_costs)
         # reuse the sampled values
-        for i in range(len(model.sampled_values)):
-          feed_dict[model.sampled_values[i][0]] = sampled_vals[i][0]
-          feed_dict[model.sampled_values[i][1]] = sampled_vals[i][1]
-          feed_dict[model.sampled_values[i][2]] = sampled_vals[i][2]
+        for sampled_tensor, sampled_val in zip(model.sampled_values, sampled_vals):
+          feed_dict[sampled_tensor] = sampled_val
 
         for i in range(1, len(vocab_subset)):
-          feed_dict[placeholder][:] = lang_vocab[vocab_subset[i]]
+          SetContext(lang_vocab[vocab_subset[i]])
           costs.append(session.run(model.per_sentence_loss, feed_dict))
       else:  # full softmax
         for i in range(len(vocab_subset)):
-          feed_dict[placeholder][:] = lang_vocab[vocab_subset[i]]
+          SetContext(lang_vocab[vocab_subset[i]])
           costs.append(session.run(model.per_sentence_loss, feed_dict))
         
       return np.array(costs)
@@ -556,7 +652,7 @@ def Eval(expdir):
 
   print 'loading model'
   if params.use_hash_table:
-    model.myhash.init.run(session=session)
+    model.InitHashTable(session)
   saver.restore(session, os.path.join(expdir, 'model.bin'))
 
   total_word_count = 0
@@ -567,22 +663,20 @@ def Eval(expdir):
     feed_dict = GetFeedDict(batch, use_dropout=False)
     lens = feed_dict[model.seq_len]
 
-    cost, sentence_costs = session.run([model.cost, model.per_sentence_loss],
-                                       feed_dict)
+    batch_loss, batch_words, sentence_costs = session.run(
+      [model.total_loss, model.num_words, model.per_sentence_loss], feed_dict)
 
-    for length, idx, sentence_cost in zip(lens, batch.index, sentence_costs):
-      batch_row = batch.loc[idx]
+    for i, (length, sentence_cost) in enumerate(zip(lens, sentence_costs)):
       data_row = {'length': length, 'cost': sentence_cost}
       for context_var in params.context_vars:
         if context_vocabs[context_var]:
-          data_row[context_var] = batch_row['orig_{0}'.format(context_var)]
+          data_row[context_var] = batch['orig_{0}'.format(context_var)][i]
         else:
-          data_row[context_var] = batch_row[context_var]
+          data_row[context_var] = batch[context_var][i]
       results.append(data_row)
 
-    words_in_batch = sum(lens - 1)
-    total_word_count += words_in_batch
-    total_log_prob += float(cost * words_in_batch)
+    total_word_count += float(batch_words)
+    total_log_prob += float(batch_loss)
     print '{0}\t{1:.3f}'.format(pos, np.exp(total_log_prob / total_word_count))
 
   results = pandas.DataFrame(results)
@@ -591,7 +685,7 @@ def Eval(expdir):
 
 def TopNextProbs(expdir):
   if params.use_hash_table:
-    model.myhash.init.run(session=session)
+    model.InitHashTable(session)
   saver.restore(session, os.path.join(expdir, 'model.bin'))
 
   words = '<S> the'.split()
@@ -647,7 +741,7 @@ def Process(fixed_context, greedy=True):
 
 def Greedy(expdir):
   if params.use_hash_table:
-    model.myhash.init.run(session=session)
+    model.InitHashTable(session)
   saver.restore(session, os.path.join(expdir, 'model.bin'))
     
   for idx in range(20000):
@@ -1,58 +1,195 @@
 # code for loading, saving, and creating vocabularies
 import argparse
 import collections
+import hashlib
 import numpy as np
+import os
 import pickle
 import re
+import struct
 
 
-class Vocab(object):
+def CountTokens(lines):
+  token_counts = collections.Counter()
+  for line in lines:
+    token_counts.update(line)
+  return token_counts
 
-  def __init__(self, tokenset, unk_symbol='<UNK>', token_counts=None):
-    self.vocab_size = len(tokenset)
-    self.unk_symbol = unk_symbol
 
-    # make <UNK> be in the zero spot
-    all_tokens = sorted(tokenset)
-    if '<UNK>' in all_tokens:
-      idx = all_tokens.index('<UNK>')  # find the unk
-      if idx > 0:
-        all_tokens[0], all_tokens[idx] = '<UNK>', all_tokens[0]
-    self.word_to_idx = dict(zip(all_tokens, range(self.vocab_size)))
-    self.idx_to_word = dict(zip(self.word_to_idx.values(),
-                            self.word_to_idx.keys()))
+# The binary format starts with this header, then the unk symbol padded to a
+# multiple of 8 bytes, the int64 word offsets, the int64 token counts if flags
+# has HAS_COUNTS set and finally the concatenated words.
+VOCAB_MAGIC = 'CALMVOCB'
+VOCAB_VERSION = 1
+HAS_COUNTS = 1
+_HEADER = struct.Struct('<8sIIQQ')  # magic, version, flags, num words, unk length
+
 
+def _Padding(n):
+  return -n % 8
+
+
+class Vocab(object):
+  """Maps between tokens and ids.
+
+  The words are stored back-to-back in one byte array with an array of
+  offsets, so that looking up a word by id and loading a saved vocabulary
+  do not need a python object per word. The token to id dict is only built
+  when it is first needed.
+  """
+  __slots__ = ('unk_symbol', 'token_counts', '_words', '_offsets',
+               '_word_to_idx', '_fingerprint')
+
+  def __init__(self, tokenset, unk_symbol='<UNK>', token_counts=None,
+               sort_by_count=False):
+    """Assigns ids to the tokens.
+
+    By default the ids are in alphabetical order with <UNK> swapped into the
+    zero spot. With sort_by_count, <UNK> gets 0, </S> gets 1 and the other
+    tokens follow in order of decreasing count.
+    """
+    if sort_by_count and token_counts:
+      pinned = [w for w in (unk_symbol, '</S>') if w in tokenset]
+      others = sorted(set(tokenset) - set(pinned),
+                      key=lambda w: (-token_counts[w], w))
+      all_tokens = pinned + others
+    else:
+      # make <UNK> be in the zero spot
+      all_tokens = sorted(tokenset)
+      if '<UNK>' in all_tokens:
+        idx = all_tokens.index('<UNK>')  # find the unk
+        if idx > 0:
+          all_tokens[0], all_tokens[idx] = '<UNK>', all_tokens[0]
 
     if token_counts:
-      self.token_counts = [token_counts[self.idx_to_word[i]] for i in
-                           range(self.vocab_size)]
+      token_counts = [token_counts[w] for w in all_tokens]
     else:
-      self.token_counts = None
+      token_counts = None
+    self._SetWords(all_tokens, unk_symbol, token_counts)
+    self._word_to_idx = dict(zip(all_tokens, xrange(len(all_tokens))))
+
+  def _SetWords(self, words, unk_symbol, token_counts):
+    words = [w.encode('utf8') if isinstance(w, unicode) else str(w)
+             for w in words]
+    self.unk_symbol = unk_symbol
+    self._offsets = np.zeros(len(words) + 1, dtype=np.int64)
+    np.cumsum([len(w) for w in words], out=self._offsets[1:])
+    self._words = np.array(bytearray(''.join(words)), dtype=np.uint8)
+    if token_counts is not None:
+      token_counts = np.array(token_counts, dtype=np.int64)
+    self.token_counts = token_counts
+    self._word_to_idx = None
+    self._fingerprint = None
+
+  def __getstate__(self):
+    return {'unk_symbol': self.unk_symbol, 'token_counts': self.token_counts,
+            'words': self._words.tostring(), 'offsets': np.array(self._offsets)}
+
+  def __setstate__(self, state):
+    if 'idx_to_word' in state:  # pickled by the old dict based version
+      words = [state['idx_to_word'][i] for i in xrange(state['vocab_size'])]
+      self._SetWords(words, state['unk_symbol'], state['token_counts'])
+      return
+    self.unk_symbol = state['unk_symbol']
+    self.token_counts = state['token_counts']
+    self._words = np.frombuffer(state['words'], dtype=np.uint8)
+    self._offsets = state['offsets']
+    self._word_to_idx = None
+    self._fingerprint = None
+
+  @property
+  def vocab_size(self):
+    return len(self._offsets) - 1
+
+  @property
+  def word_to_idx(self):
+    if self._word_to_idx is None:
+      words = self.GetWords()
+      self._word_to_idx = dict(zip(words, xrange(len(words))))
+    return self._word_to_idx
 
   def GetUnigramProbs(self):
-    if self.token_counts:
-      return np.array(self.token_counts) / float(sum(self.token_counts))
+    if self.token_counts is not None:
+      return self.token_counts / float(self.token_counts.sum())
     return None
 
-  @staticmethod
-  def Load(filename):
+  @classmethod
+  def Load(cls, filename):
+    """Load a vocabulary saved in the binary format or as a pickle."""
     with open(filename, 'rb') as f:
+      if f.read(len(VOCAB_MAGIC)) == VOCAB_MAGIC:
+        return cls._LoadBinary(filename)
+      f.seek(0)
       v = pickle.load(f)
     return v
 
+  @classmethod
+  def LoadSaved(cls, expdir, name):
+    """Load a vocabulary saved by a training run.
+
+    Runs save name.vocab files, older runs saved name.pickle instead.
+    """
+    filename = os.path.join(expdir, name + '.vocab')
+    if not os.path.exists(filename):
+      filename = os.path.join(expdir, name + '.pickle')
+    return cls.Load(filename)
+
+  @classmethod
+  def _LoadBinary(cls, filename):
+    buf = np.memmap(filename, dtype=np.uint8, mode='r')
+    _, version, flags, num_words, unk_len = _HEADER.unpack(
+      buf[:_HEADER.size].tostring())
+    if version > VOCAB_VERSION:
+      raise ValueError('{0} has unsupported vocab version {1}'.format(
+        filename, version))
+
+    def Take(size):
+      start = Take.pos
+      Take.pos += size + _Padding(size)
+      return buf[start:start + size]
+    Take.pos = _HEADER.size
+
+    v = cls.__new__(cls)
+    v.unk_symbol = Take(unk_len).tostring()
+    v._offsets = Take(8 * (num_words + 1)).view('<i8')
+    v.token_counts = None
+    if flags & HAS_COUNTS:
+      v.token_counts = Take(8 * num_words).view('<i8')
+    v._words = Take(v._offsets[-1])
+    v._word_to_idx = None
+    v._fingerprint = None
+    return v
+
   @classmethod
   def MakeFromData(cls, lines, min_count, unk_symbol='<UNK>',
-                   max_length=None, no_special_syms=False):
-    token_counts = collections.Counter()
+                   max_length=None, no_special_syms=False, max_size=None,
+                   sort_by_count=False):
+    return cls.MakeFromCounts(CountTokens(lines), min_count, unk_symbol=unk_symbol,
+                              max_length=max_length, no_special_syms=no_special_syms,
+                              max_size=max_size, sort_by_count=sort_by_count)
+
+  @classmethod
+  def MakeFromCounts(cls, token_counts, min_count, unk_symbol='<UNK>',
+                     max_length=None, no_special_syms=False, max_size=None,
+                     sort_by_count=False):
+    """Like MakeFromData but starting from a counter of the tokens.
 
-    for line in lines:
-      token_counts.update(line)
+    If max_size is given only the most frequent tokens are kept so that the
+    vocabulary, including <UNK> and </S>, has at most max_size entries.
+    """
+    token_counts = collections.Counter(token_counts)
+
+    words = [w for w in token_counts.keys()
+             if not (max_length and len(w) > max_length)]
+    kept = set(w for w in words if token_counts[w] >= min_count)
+    pinned = set([unk_symbol] if no_special_syms else [unk_symbol, '</S>'])
+    if max_size and len(kept | pinned) > max_size:
+      others = sorted(kept - pinned, key=lambda w: (-token_counts[w], w))
+      kept = (kept & pinned) | set(others[:max_size - len(pinned)])
 
     tokenset = set()
-    for word in token_counts.keys():
-      if max_length and len(word) > max_length:
-        continue
-      if token_counts[word] >= min_count:
+    for word in words:
+      if word in kept:
         tokenset.add(word)
       else:
         tokenset.add(unk_symbol)
@@ -62,7 +199,8 @@ class Vocab(object):
       tokenset.add(unk_symbol)
       tokenset.add('</S>')
 
-    return cls(tokenset, unk_symbol=unk_symbol, token_counts=token_counts)
+    return cls(tokenset, unk_symbol=unk_symbol, token_counts=token_counts,
+               sort_by_count=sort_by_count)
 
 
   @classmethod
@@ -74,43 +212,103 @@ class Vocab(object):
         tokens.append(line)
     return cls(tokens, unk_symbol=unk_symbol)
 
+  def Fingerprint(self):
+    """Hash of the vocabulary contents, used to key caches."""
+    if self._fingerprint is None:
+      h = hashlib.md5(self.unk_symbol)
+      h.update(np.ascontiguousarray(self._offsets, dtype='<i8').tostring())
+      h.update(self._words.tostring())
+      self._fingerprint = h.hexdigest()
+    return self._fingerprint
+
   def GetWords(self):
     """Get a list of words in the vocabulary."""
-    return [self.idx_to_word[i] for i in xrange(len(self.word_to_idx))]
-  
+    words = self._words.tostring()
+    offsets = self._offsets.tolist()
+    return [words[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+  def GetWord(self, idx):
+    if idx < 0 or idx >= self.vocab_size:
+      raise KeyError(idx)
+    return self._words[self._offsets[idx]:self._offsets[idx + 1]].tostring()
+
   def LookupIdx(self, token):
     if token in self.word_to_idx:
       return self.word_to_idx[token]
     return self.word_to_idx.get(self.unk_symbol, None)
 
+  def LookupIdxs(self, tokens):
+    """Lookup the ids for a sequence of tokens, returns an int32 array."""
+    get = self.word_to_idx.get
+    unk = self.word_to_idx.get(self.unk_symbol, -1)
+    return np.fromiter((get(t, unk) for t in tokens), dtype=np.int32,
+                       count=len(tokens))
+
+  def LookupIds(self, lines, pad_length, pad_symbol='</S>'):
+    """Convert a list of tokenized lines to a padded matrix of ids.
+
+    Lines longer than pad_length are truncated.
+
+    Returns:
+      An int32 matrix of shape [len(lines), pad_length] and an int32 array
+      with the number of tokens from each line that were kept.
+    """
+    lengths = np.fromiter((len(line) for line in lines), dtype=np.int32,
+                          count=len(lines))
+    np.minimum(lengths, pad_length, out=lengths)
+    get = self.word_to_idx.get
+    unk = self.word_to_idx.get(self.unk_symbol, -1)
+    flat = np.fromiter((get(w, unk) for line in lines for w in line[:pad_length]),
+                       dtype=np.int32, count=lengths.sum())
+
+    ids = np.empty((len(lines), pad_length), dtype=np.int32)
+    ids.fill(self.LookupIdx(pad_symbol))
+    ids[np.arange(pad_length) < lengths[:, np.newaxis]] = flat
+    return ids, lengths
+
   def __contains__(self, key):
     return key in self.word_to_idx
 
   def __getitem__(self, key):
     """If key is an int lookup word by id, if key is a word then lookup id."""
-    if type(key) == int or type(key) == np.int64:
-      return self.idx_to_word[key]
+    if isinstance(key, (int, long, np.integer)):
+      return self.GetWord(key)
 
     return self.LookupIdx(key)
 
   def __iter__(self):
-    word_list = [self.idx_to_word[x] for x in xrange(self.vocab_size)]
-    return word_list.__iter__()
+    return iter(self.GetWords())
 
   def __len__(self):
     return self.vocab_size
 
   def Save(self, filename):
-    if filename.endswith('.pickle'):
+    if filename.endswith('.vocab'):
+      self._SaveBinary(filename)
+    elif filename.endswith('.pickle'):
      with open(filename, 'wb') as f:
       pickle.dump(self, f)
     elif filename.endswith('.txt'):
       with open(filename, 'w') as f:
-        for i in range(self.vocab_size):
-          f.write('{0}\n'.format(self.idx_to_word[i]))
+        for w in self.GetWords():
+          f.write('{0}\n'.format(w))
     else:
       print 'ERROR: bad file extension'
 
+  def _SaveBinary(self, filename):
+    flags = HAS_COUNTS if self.token_counts is not None else 0
+    with open(filename, 'wb') as f:
+      f.write(_HEADER.pack(VOCAB_MAGIC, VOCAB_VERSION, flags, self.vocab_size,
+                           len(self.unk_symbol)))
+      arrays = [self.unk_symbol,
+                np.asarray(self._offsets, dtype='<i8').tostring()]
+      if flags & HAS_COUNTS:
+        arrays.append(np.asarray(self.token_counts, dtype='<i8').tostring())
+      arrays.append(self._words.tostring())
+      for data in arrays:
+        f.write(data)
+        f.write('\0' * _Padding(len(data)))
+
   @staticmethod
   def Graphemes(s):
     """ Given a string return a list of graphemes.
@@ -155,7 +353,7 @@ if __name__ == '__main__':
   parser.add_argument('filename')
   args = parser.parse_args()
 
-  if args.filename.endswith('.pickle'):
+  if args.filename.endswith('.pickle') or args.filename.endswith('.vocab'):
     #with open(args.filename, 'rb') as f:
     #  vs = pickle.load(f)
     #  v = vs['subreddit']